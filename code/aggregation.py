@@ -0,0 +1,13 @@
+import torch
+
+
+# 矩阵形式的加权聚合：k 个展平更新按行堆叠为 [k, d] 矩阵 U，计算 U^T w (单次 GEMV)
+# out 不为 None 时原地累加到 out (例如全局模型的连续参数缓冲区)，否则返回新的聚合向量
+def weighted_update_sum(update_rows, weights, out=None):
+    reference = out if out is not None else update_rows[0]
+    if isinstance(update_rows, torch.Tensor): updates = update_rows.to(reference.device, reference.dtype)
+    else: updates = torch.stack([u.to(reference.device, reference.dtype) for u in update_rows])
+    weights = torch.as_tensor(weights, dtype=reference.dtype, device=reference.device)
+    if out is None: return torch.mv(updates.t(), weights)
+    with torch.no_grad():
+        return out.addmv_(updates.t(), weights)
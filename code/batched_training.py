@@ -0,0 +1,74 @@
+import torch
+import torch.nn.functional as F
+from torch.func import functional_call, vmap, grad
+
+
+# 单个客户端在一个批次上的损失；w 为样本掩码，补齐的样本权重为 0，
+# 因此梯度与对真实样本取平均的 CrossEntropyLoss 完全一致
+def _masked_client_loss(model, params, inputs, labels, weights):
+    outputs = functional_call(model, params, (inputs,))
+    per_sample_loss = F.cross_entropy(outputs, labels, reduction='none')
+    return (per_sample_loss * weights).sum() / weights.sum().clamp(min=1.0)
+
+
+# 为一组客户端构造 [C, steps, B] 的样本索引矩阵，-1 表示补齐位置
+def _build_step_indices(clients, epoch, batch_size):
+    orders = []
+    for c in clients:
+        if epoch < c.local_epochs: orders.append(c.train_loader.epoch_indices())
+        else: orders.append(torch.empty(0, dtype=torch.long))
+    num_steps = max((len(o) + c.batch_size - 1) // c.batch_size for c, o in zip(clients, orders))
+    step_indices = torch.full((len(clients), num_steps * batch_size), -1, dtype=torch.long)
+    for i, (c, order) in enumerate(zip(clients, orders)):
+        # 按客户端自身的 batch_size 切分，再放入统一宽度的批次槽位
+        for step, start in enumerate(range(0, len(order), c.batch_size)):
+            chunk = order[start: start + c.batch_size]
+            step_indices[i, step * batch_size: step * batch_size + len(chunk)] = chunk
+    return step_indices.view(len(clients), num_steps, batch_size)
+
+
+# 批量本地训练：堆叠所有客户端的模型参数，用 vmap(functional_call) 同步执行每个客户端的 SGD
+def train_clients_batched(clients, client_chunk_size=None):
+    clients = [c for c in clients if c.model is not None and len(c.train_loader.dataset) > 0]
+    if not clients: return
+    chunk_size = client_chunk_size or len(clients)
+    for start in range(0, len(clients), chunk_size):
+        _train_chunk(clients[start: start + chunk_size])
+    for c in clients:
+        c.perf_after_local_train, _ = c.evaluate_model(on_val_set=True)
+
+
+def _train_chunk(clients):
+    template = clients[0].model
+    device = next(template.parameters()).device
+    data = clients[0].train_loader.dataset.base_data
+    targets = clients[0].train_loader.dataset.base_targets
+    if any(c.train_loader.dataset.base_data is not data for c in clients):
+        raise ValueError("批量训练要求所有客户端共享同一份底层数据张量")
+
+    names = [name for name, _ in template.named_parameters()]
+    params = {name: torch.stack([dict(c.model.named_parameters())[name].detach() for c in clients]).clone()
+              for name in names}
+    lrs = torch.tensor([c.lr for c in clients], dtype=params[names[0]].dtype, device=device)
+    batch_size = max(c.batch_size for c in clients)
+    grad_fn = vmap(grad(lambda p, x, y, w: _masked_client_loss(template, p, x, y, w)))
+
+    template.train()
+    for epoch in range(max(c.local_epochs for c in clients)):
+        step_indices = _build_step_indices(clients, epoch, batch_size)
+        for step in range(step_indices.size(1)):
+            batch_indices = step_indices[:, step]
+            weights = (batch_indices >= 0).to(device=device, dtype=lrs.dtype)
+            safe_indices = batch_indices.clamp(min=0)
+            inputs = data[safe_indices].to(device)
+            labels = targets[safe_indices].to(device)
+            grads = grad_fn(params, inputs, labels, weights)
+            # 当前步没有样本的客户端学习率置零，保持参数不变
+            step_lrs = lrs * (weights.sum(dim=1) > 0)
+            for name in names:
+                params[name].sub_(grads[name] * step_lrs.view(-1, *([1] * (params[name].dim() - 1))))
+
+    with torch.no_grad():
+        for i, c in enumerate(clients):
+            for name, param in c.model.named_parameters():
+                param.copy_(params[name][i])
@@ -0,0 +1,40 @@
+import torch
+from data_cache import base_tensors_on
+
+
+# 轮次级的全局模型评估：所有诚实客户端在本轮开始时评估的是同一个全局模型，
+# 这里把各客户端本地数据 (即 evaluate_model(on_val_set=True) 使用的完整数据集) 的索引拼接起来，
+# 以大批次只前向一遍，再按所属客户端分段累加正确数 (留在设备上，最后同步一次)，
+# 把准确率散回各客户端的 perf_before_local_train，与逐客户端评估的结果相同。
+class ClientDataEvaluator:
+    def __init__(self, batch_size=4096, device=None):
+        self.batch_size = batch_size
+        self.device = device
+
+
+    # 返回 {客户端 id: 准确率}，并写入各客户端的 perf_before_local_train
+    def evaluate(self, model, clients):
+        clients = list(clients)
+        if not clients: return {}
+        data = clients[0].dataset.base_data
+        if any(c.dataset.base_data is not data for c in clients):
+            raise ValueError("合并评估要求所有客户端共享同一份底层数据张量")
+        device = self.device if self.device is not None else next(model.parameters()).device
+        data, targets = base_tensors_on(clients[0].dataset, device)
+
+        lengths = torch.tensor([len(c.dataset) for c in clients], device=device)
+        indices = torch.cat([c.dataset.indices for c in clients]).to(device)
+        owners = torch.repeat_interleave(torch.arange(len(clients), device=device), lengths)
+        correct = torch.zeros(len(clients), device=device)
+        model.eval()
+        with torch.no_grad():
+            for start in range(0, len(indices), self.batch_size):
+                batch_indices = indices[start: start + self.batch_size]
+                _, predicted = torch.max(model(data[batch_indices]), 1)
+                correct.index_add_(0, owners[start: start + self.batch_size], (predicted == targets[batch_indices]).float())
+
+        accuracies = {}
+        for c, num_correct, num_samples in zip(clients, correct.tolist(), lengths.tolist()):
+            c.perf_before_local_train = num_correct / num_samples if num_samples > 0 else 0.0
+            accuracies[c.id] = c.perf_before_local_train
+        return accuracies
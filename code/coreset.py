@@ -0,0 +1,58 @@
+import math
+import torch
+from testset_evaluation import HeldOutEvaluator
+
+
+# 类别分层的 k-center 核心集：在每个类别内部按样本占比分配名额 (至少 1 个)，
+# 以离类别均值最近的样本为起点，贪心地反复加入离已选中心最远的样本 (farthest-point)；
+# 再做 refine_iters 次 medoid 修正 (中心换成离其簇均值最近的样本)，避免中心集中在离群点上、权重过于悬殊。
+# 每个样本归属最近的中心，中心的权重即其代表的样本数，权重之和等于原始样本数。
+# 返回 (中心在 features 中的下标, 权重)
+def stratified_k_center(features, labels, size, refine_iters=5):
+    num_samples = len(labels)
+    indices, weights = [], []
+    for c in labels.unique().tolist():
+        class_indices = torch.nonzero(labels == c).flatten()
+        class_features = features[class_indices]
+        quota = min(len(class_indices), max(1, round(size * len(class_indices) / num_samples)))
+
+        first = int(torch.argmin((class_features - class_features.mean(dim=0)).pow(2).sum(dim=1)))
+        centers = [first]
+        min_dist = (class_features - class_features[first]).pow(2).sum(dim=1)
+        nearest = torch.zeros(len(class_indices), dtype=torch.long, device=features.device)
+        for k in range(1, quota):
+            nxt = int(torch.argmax(min_dist))
+            dist = (class_features - class_features[nxt]).pow(2).sum(dim=1)
+            closer = dist < min_dist
+            nearest[closer] = k
+            min_dist = torch.minimum(min_dist, dist)
+            centers.append(nxt)
+
+        centers = torch.tensor(centers, dtype=torch.long, device=features.device)
+        for _ in range(refine_iters):
+            sums = torch.zeros(quota, class_features.shape[1], dtype=class_features.dtype, device=features.device)
+            sums.index_add_(0, nearest, class_features)
+            counts = torch.bincount(nearest, minlength=quota).clamp(min=1).unsqueeze(1)
+            new_centers = torch.cdist(sums / counts, class_features).argmin(dim=1)
+            if torch.equal(new_centers, centers): break
+            centers = new_centers
+            nearest = torch.cdist(class_features, class_features[centers]).argmin(dim=1)
+
+        indices.append(class_indices[centers])
+        weights.append(torch.bincount(nearest, minlength=quota).to(torch.float64))
+    return torch.cat(indices), torch.cat(weights)
+
+
+# 由 (较早的) 全局模型的倒数第二层特征构建紧凑验证集 (加权的 HeldOutEvaluator)，只在训练早期构建一次。
+# 同时返回其准确率误差的统计估计：把每个中心看作代表其权重份额的样本，
+# 加权准确率的标准差不超过 0.5 · sqrt(Σ (w_i / n)²)，这里取两倍标准差
+def build_verification_coreset(model, evaluator, size, batch_size=None):
+    model.eval()
+    with torch.no_grad():
+        features = torch.cat([model.features(evaluator.inputs[start: start + evaluator.batch_size])
+                              for start in range(0, len(evaluator.labels), evaluator.batch_size)])
+    indices, weights = stratified_k_center(features, evaluator.labels, size)
+    coreset = HeldOutEvaluator(evaluator.inputs[indices], evaluator.labels[indices], evaluator.device,
+                               batch_size or evaluator.batch_size, sample_weights=weights)
+    statistical_error = 2.0 * 0.5 * math.sqrt(float((weights / weights.sum()).pow(2).sum()))
+    return coreset, statistical_error
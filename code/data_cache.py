@@ -0,0 +1,198 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from torchvision import datasets
+from torch.utils.data import Dataset
+
+MNIST_DATA_ROOT = '/data/ddh/data'
+MNIST_MEAN, MNIST_STD = 0.1307, 0.3081
+
+# 进程内缓存：同一进程中的所有 Simulation 共享已归一化的张量
+_MNIST_TENSOR_CACHE = {}
+
+
+# 张量视图数据集，等价于 Subset(MNIST, indices)，但直接索引预处理好的张量
+class TensorSubset(Dataset):
+    def __init__(self, base_data, base_targets, indices=None, source=None):
+        self.base_data = base_data
+        self.base_targets = base_targets
+        if indices is None: indices = torch.arange(len(base_targets))
+        self.indices = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+        self.source = source # (data_root, train)：来自张量缓存时记录来源，跨进程传递时只传索引
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.source is not None: state['base_data'] = state['base_targets'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.source is not None: self.base_data, self.base_targets = load_mnist_tensors(*self.source)
+
+
+    def __len__(self):
+        return len(self.indices)
+
+
+    def __getitem__(self, idx):
+        i = self.indices[idx]
+        return self.base_data[i], int(self.base_targets[i])
+
+
+    @property
+    def targets(self):
+        return self.base_targets[self.indices]
+
+
+    # 取子集，返回共享底层张量的新视图
+    def subset(self, positions):
+        positions = torch.as_tensor(np.asarray(positions), dtype=torch.long)
+        return TensorSubset(self.base_data, self.base_targets, self.indices[positions], self.source)
+
+
+    # 与 torch.utils.data.random_split 相同的随机划分方式，返回 TensorSubset
+    def random_split(self, lengths, generator=None):
+        perm = torch.randperm(sum(lengths), generator=generator)
+        splits, offset = [], 0
+        for length in lengths:
+            splits.append(self.subset(perm[offset: offset + length]))
+            offset += length
+        return splits
+
+
+def _mnist_cache_files(data_root, train):
+    cache_dir = os.path.join(data_root, 'mnist_tensor_cache')
+    split = 'train' if train else 'test'
+    return cache_dir, os.path.join(cache_dir, f'{split}_images.npy'), os.path.join(cache_dir, f'{split}_labels.npy')
+
+
+# 加载归一化后的 MNIST 张量；首次调用时写入可内存映射的 .npy 文件
+def load_mnist_tensors(data_root=MNIST_DATA_ROOT, train=True):
+    key = (os.path.abspath(data_root), train)
+    if key in _MNIST_TENSOR_CACHE: return _MNIST_TENSOR_CACHE[key]
+
+    cache_dir, images_file, labels_file = _mnist_cache_files(data_root, train)
+    if not (os.path.exists(images_file) and os.path.exists(labels_file)):
+        raw = datasets.MNIST(data_root, train=train, download=True)
+        # 与 ToTensor + Normalize 完全一致的运算顺序
+        images = raw.data.unsqueeze(1).float().div(255).sub_(MNIST_MEAN).div_(MNIST_STD).contiguous()
+        labels = raw.targets.clone().long()
+        os.makedirs(cache_dir, exist_ok=True)
+        for path, array in ((images_file, images.numpy()), (labels_file, labels.numpy())):
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f: np.save(f, array)
+            os.replace(tmp_path, path)
+
+    # mmap_mode='c'：写时复制，多个进程共享只读页面
+    images = torch.from_numpy(np.load(images_file, mmap_mode='c'))
+    labels = torch.from_numpy(np.load(labels_file))
+    _MNIST_TENSOR_CACHE[key] = (images, labels)
+    return images, labels
+
+
+def mnist_tensor_dataset(data_root=MNIST_DATA_ROOT, train=True):
+    images, labels = load_mnist_tensors(data_root, train)
+    return TensorSubset(images, labels, source=(data_root, train))
+
+
+# 按设备缓存底层张量，所有客户端共享同一份设备端数据
+_DEVICE_TENSOR_CACHE = {}
+
+
+def base_tensors_on(dataset, device):
+    if device is None or torch.device(device).type == 'cpu': return dataset.base_data, dataset.base_targets
+    key = (id(dataset.base_data), str(device))
+    if key not in _DEVICE_TENSOR_CACHE:
+        _DEVICE_TENSOR_CACHE[key] = (dataset.base_data.to(device), dataset.base_targets.to(device))
+    return _DEVICE_TENSOR_CACHE[key]
+
+
+# 轻量批迭代器：用 randperm 打乱索引张量并直接切片预加载的张量，不启动任何 worker 进程
+class TensorBatchIterator:
+    def __init__(self, dataset, batch_size, shuffle=False, device=None, generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = device
+        self.generator = generator
+
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+
+    # 一个 epoch 的样本索引（相对于底层张量）
+    def epoch_indices(self):
+        indices = self.dataset.indices
+        if self.shuffle: indices = indices[torch.randperm(len(indices), generator=self.generator)]
+        return indices
+
+
+    def __iter__(self):
+        data, targets = base_tensors_on(self.dataset, self.device)
+        indices = self.epoch_indices().to(data.device)
+        for start in range(0, len(indices), self.batch_size):
+            batch_indices = indices[start: start + self.batch_size]
+            inputs, labels = data[batch_indices], targets[batch_indices]
+            if self.device is not None: inputs, labels = inputs.to(self.device), labels.to(self.device)
+            yield inputs, labels
+
+
+def _partition_cache_file(cache_dir, labels, seed, num_clients, alpha, min_size, refill):
+    labels_key = f'{len(labels)}_{hashlib.sha1(np.ascontiguousarray(labels).tobytes()).hexdigest()[:12]}'
+    return os.path.join(cache_dir, f'dirichlet_{labels_key}_seed{seed}_n{num_clients}_alpha{float(alpha)!r}'
+                                   f'_min{min_size}_{refill}.npz')
+
+
+# 向量化的 Dirichlet Non-IID 划分，返回每个客户端的样本索引数组。
+# 样本过少的客户端按 refill 处理：
+#   'replace' — 少于 min_size // num_classes 个样本的客户端整体换成 min_size 个随机样本 (原 system.get_mnist_data 的行为)
+#   'top_up'  — 少于 min_size 个样本的客户端用随机样本补足到 min_size (原 gradient_analysis.get_mnist_data 的行为)
+# 只有给定 seed 时才按 (标签长度与哈希, seed, num_clients, alpha, min_size, refill) 缓存到磁盘，随机种子的划分不会被复用
+def dirichlet_partition(labels, num_clients, alpha, min_size=10, seed=None, cache_dir=None, refill='replace'):
+    if refill not in ('replace', 'top_up'): raise ValueError(f"未知的 refill 方式: {refill}")
+    labels = np.asarray(labels)
+    cache_file = None
+    if seed is None: seed = int(np.random.randint(2**31 - 1))
+    elif cache_dir: cache_file = _partition_cache_file(cache_dir, labels, seed, num_clients, alpha, min_size, refill)
+    if cache_file and os.path.exists(cache_file):
+        with np.load(cache_file) as cached:
+            return np.split(cached['flat_indices'], cached['offsets'][1:-1])
+
+    num_classes = int(labels.max()) + 1
+    rng = np.random.default_rng(seed)
+    # 先整体打乱，再按类别稳定排序，得到每个类别内部随机排列的样本
+    shuffled = rng.permutation(len(labels))
+    by_class = shuffled[np.argsort(labels[shuffled], kind='stable')]
+    class_counts = np.bincount(labels, minlength=num_classes)
+    proportions = rng.dirichlet([alpha] * num_clients, size=num_classes)
+    target_counts = (proportions * class_counts[:, None]).astype(np.int64)
+    # 取整残差一次性随机分配给各客户端
+    residue = class_counts - target_counts.sum(axis=1)
+    residue_classes = np.repeat(np.arange(num_classes), residue)
+    np.add.at(target_counts, (residue_classes, rng.integers(num_clients, size=residue_classes.size)), 1)
+
+    client_of_sample = np.repeat(np.tile(np.arange(num_clients), num_classes), target_counts.ravel())
+    flat_indices = by_class[np.argsort(client_of_sample, kind='stable')]
+    partitions = np.split(flat_indices, np.cumsum(target_counts.sum(axis=0))[:-1])
+
+    client_sizes = target_counts.sum(axis=0)
+    if refill == 'replace':
+        for i in np.flatnonzero(client_sizes < min_size // num_classes):
+            partitions[i] = rng.choice(len(labels), size=min(len(labels), min_size), replace=False)
+    else:
+        for i in np.flatnonzero(client_sizes < min_size):
+            candidates = rng.choice(len(labels), size=min(len(labels), min_size + len(partitions[i])), replace=False)
+            extra = candidates[~np.isin(candidates, partitions[i])][:min_size - len(partitions[i])]
+            partitions[i] = np.concatenate([partitions[i], extra])
+
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        offsets = np.concatenate([[0], np.cumsum([len(p) for p in partitions])])
+        tmp_path = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f: np.savez(f, flat_indices=np.concatenate(partitions), offsets=offsets)
+        os.replace(tmp_path, cache_file)
+    return partitions
@@ -5,6 +5,9 @@ import random
 
 
 class FreeRider(Participant):
+    # 并行执行时由工作进程回传给主进程的轮次状态
+    round_state_fields = ("atk_phase", "est_lambda_bar", "est_cos_beta")
+
     def __init__(self, id, init_rep, tra_round_num, device,
                  est_round_num, 
                  atk_c_param,
@@ -24,13 +27,31 @@ class FreeRider(Participant):
         self.atk_phase = "parameter_estimation"     # 攻击阶段，初始为参数估计阶段 
         self.last_gt = None                         # 上一轮全局梯度
         self.sec_last_gt = None                     # 上上轮全局梯度                     
+        self.last_gt_norm = None                    # 上一轮全局梯度范数 (取自历史缓冲区的缓存)
+        self.sec_last_gt_norm = None                # 上上轮全局梯度范数
+        self.global_state_view = None               # 本轮共享的全局参数视图
+        self.observed_round = None                  # 已根据全局更新历史更新过攻击状态的轮次
+        # 独立的随机数生成器，保证并行执行与串行执行生成相同的噪声
+        self.generator = torch.Generator(device=device).manual_seed(int(torch.randint(2**62, (1,)).item()))
     
 
-    # 更新估计历史
+    # 搭便车者不训练、不修改本地模型，只引用共享的全局参数 (写时复制：从不写，因此从不拷贝)
+    def set_model_state(self, state_dict):
+        self.global_state_view = state_dict
+
+
+    # 被淘汰后不再引用全局参数视图和历史中的全局更新
+    def release_resources(self):
+        super().release_resources()
+        self.global_state_view = None
+        self.last_gt, self.sec_last_gt = None, None
+
+
+    # 更新估计历史 (gt_flat_history 为 UpdateHistoryBuffer，范数已缓存)
     def _update_estimation_history(self, gt_flat_history):
         if gt_flat_history: 
             if len(gt_flat_history) > 0:
-                 gt_norm = torch.linalg.norm(gt_flat_history[-1]).item() # 计算最新的 g_t 的范数
+                 gt_norm = gt_flat_history.norm(-1).item() # 最新的 g_t 的范数
                  self.global_norm_diff_history.append(gt_norm)
 
 
@@ -56,8 +77,11 @@ class FreeRider(Participant):
             self.est_cos_beta = max(0, min(1, cos_beta))
 
 
-    # 生成伪造的更新
-    def gen_fabric_update(self, current_round_num, gt_flat_history, current_global_model_state, num_total_clients):
+    # 根据全局更新历史更新估计与攻击阶段 (每轮只观察一次)
+    # 先投标后训练的协议中在投标前调用，此时尚不知道是否被选中，也不需要生成更新
+    def update_attack_state(self, current_round_num, gt_flat_history):
+        if self.observed_round == current_round_num: return
+        self.observed_round = current_round_num
         # 更新全局梯度的norm历史
         self._update_estimation_history(gt_flat_history)
         # 阶段判断
@@ -69,9 +93,13 @@ class FreeRider(Participant):
             self.atk_phase = "parameter_estimation"
 
 
-        # 更新 g_t 和 g_{t-1}
-        if len(gt_flat_history) >= 1: self.last_gt = gt_flat_history[-1].to(self.device)
-        if len(gt_flat_history) >= 2: self.sec_last_gt = gt_flat_history[-2].to(self.device)
+    # 生成伪造的更新
+    def gen_fabric_update(self, current_round_num, gt_flat_history, current_global_model_state, num_total_clients):
+        self.update_attack_state(current_round_num, gt_flat_history)
+
+        # 更新 g_t 和 g_{t-1}：直接引用历史缓冲区中的视图及其缓存范数
+        if len(gt_flat_history) >= 1: self.last_gt, self.last_gt_norm = gt_flat_history[-1].to(self.device), gt_flat_history.norm(-1).to(self.device)
+        if len(gt_flat_history) >= 2: self.sec_last_gt, self.sec_last_gt_norm = gt_flat_history[-2].to(self.device), gt_flat_history.norm(-2).to(self.device)
         
         # 初始化伪造更新
         fabric_update_flat = None
@@ -80,16 +108,16 @@ class FreeRider(Participant):
         # 生成梯度逻辑
         if self.atk_phase == "parameter_estimation":
             # 如果处于参数估计阶段，使用随机噪声生成伪造更新
-            noise = torch.randn_like(flat_global_params, device=self.device) * self.atk_est_noise_std
+            noise = torch.randn(flat_global_params.shape, generator=self.generator, device=self.device) * self.atk_est_noise_std
             fabric_update_flat = noise
             self.current_update = self._unflatten_params(fabric_update_flat, current_global_model_state)
         else: 
             # 如果处于攻击阶段，使用高级攻击逻辑生成伪造更新
-            norm_g_current = torch.linalg.norm(self.last_gt)
-            norm_g_previous = torch.linalg.norm(self.sec_last_gt)
+            norm_g_current = self.last_gt_norm
+            norm_g_previous = self.sec_last_gt_norm
             scaled_delta_factor = norm_g_current / norm_g_previous # 计算缩放因子
             U_f_flat = scaled_delta_factor * self.last_gt # 生成缩放后的基础更新
-            norm_U_f_flat = torch.linalg.norm(U_f_flat) # 计算基础更新的范数
+            norm_U_f_flat = scaled_delta_factor * norm_g_current # 基础更新的范数 (缩放因子非负，无需重新计算)
             expected_cos_beta = self.est_cos_beta # 提取预期的 cos(beta)
             n = num_total_clients # 计算参与者数量
             # 计算添加噪声的幅度 phi
@@ -101,12 +129,12 @@ class FreeRider(Participant):
                 print("Warning: n <= 1, cannot calculate phi_magnitude.")
                 phi_magnitude = 0
             # 计算添加的噪声
-            noise_vector_phi = torch.randn_like(U_f_flat, device=self.device) # 生成随机噪声，服从标准正态分布
+            noise_vector_phi = torch.randn(U_f_flat.shape, generator=self.generator, device=self.device) # 生成随机噪声，服从标准正态分布
             noise_vector_phi = noise_vector_phi / (torch.linalg.norm(noise_vector_phi)) * phi_magnitude # 归一化噪声向量并缩放
             num_dims_to_add_noise = int(flat_global_params.numel() * self.atk_noise_dim) # 计算添加噪声的维度
             # 对于添加噪声的维度进行处理，剩余的维度保持不变
             if 0 < num_dims_to_add_noise < flat_global_params.numel():
-                indices_to_add_noise = torch.randperm(flat_global_params.numel(), device=self.device)[:num_dims_to_add_noise]
+                indices_to_add_noise = torch.randperm(flat_global_params.numel(), generator=self.generator, device=self.device)[:num_dims_to_add_noise]
                 U_f_flat_perturbed = U_f_flat.clone()
                 U_f_flat_perturbed[indices_to_add_noise] += noise_vector_phi[indices_to_add_noise]
                 fabric_update_flat = U_f_flat_perturbed
@@ -1,13 +1,17 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torchvision import datasets, transforms
-from torch.utils.data import DataLoader, Subset
+from torchvision import transforms
 import numpy as np
 import matplotlib.pyplot as plt
 import copy
+from collections import OrderedDict
 import random
 import os
+from data_cache import mnist_tensor_dataset, TensorBatchIterator, dirichlet_partition
+from aggregation import weighted_update_sum
+from update_stats import update_statistics, UpdateSketcher
+from update_history import UpdateHistoryBuffer
 
 # 配置参数
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -29,6 +33,11 @@ NUM_HONEST_ROUNDS_FOR_ESTIMATION_FREERIDER = 2          # 诚实轮次数目
 ADV_ATTACK_C_PARAM = 0.5                                # 计算E(cosB)的C参数
 ADV_ATTACK_NOISE_DIM_FRACTION = 0.75                    # 添加噪声的维度比例
 
+# 更新统计草图参数
+UPDATE_SKETCH_DIM = None                                # 草图维度 k (None 表示在完整更新上统计)
+UPDATE_SKETCH_METHOD = "count_sketch"                   # 草图方法: "count_sketch" / "jl"
+GLOBAL_HISTORY_CAPACITY = 10                            # 服务器保留的全局更新历史条数 (环形缓冲区)
+
 
 # 随机种子设置函数
 def set_seed(seed):
@@ -60,14 +69,13 @@ class MLP(nn.Module):
 
 # 数据集划分
 def get_mnist_data(num_clients, iid, non_iid_alpha, data_path='./data', client_batch_size=64, test_batch_size=1000):
-    transform_mnist = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))])
-    train_dataset_full = datasets.MNIST(data_path, train=True, download=True, transform=transform_mnist)
-    test_dataset_full = datasets.MNIST(data_path, train=False, download=True, transform=transform_mnist)
+    train_dataset_full = mnist_tensor_dataset(data_path, train=True)
+    test_dataset_full = mnist_tensor_dataset(data_path, train=False)
     
     client_datasets_subsets = []
     
     if num_clients == 0:
-        test_loader_local = DataLoader(test_dataset_full, batch_size=test_batch_size, shuffle=False)
+        test_loader_local = TensorBatchIterator(test_dataset_full, test_batch_size, shuffle=False, device=DEVICE)
         return [], test_loader_local
 
     if iid:
@@ -78,62 +86,30 @@ def get_mnist_data(num_clients, iid, non_iid_alpha, data_path='./data', client_b
         for i in range(num_clients):
             start_idx, end_idx = i * split_size, (i + 1) * split_size if i < num_clients - 1 else total_size
             if not indices[start_idx:end_idx]: continue
-            client_datasets_subsets.append(Subset(train_dataset_full, indices[start_idx:end_idx]))
+            client_datasets_subsets.append(train_dataset_full.subset(indices[start_idx:end_idx]))
     else:
-        labels = np.array(train_dataset_full.targets)
-        num_classes = 10
-        min_size_per_client = 10
-        
-        client_indices_map = {i: [] for i in range(num_clients)}
-        
-        for c in range(num_classes):
-            indices_c = np.where(labels == c)[0]
-            np.random.shuffle(indices_c)
-            
-            proportions = np.random.dirichlet([non_iid_alpha] * num_clients)
-
-            target_samples_for_class_c = (proportions * len(indices_c)).astype(int)
-            
-            delta = len(indices_c) - np.sum(target_samples_for_class_c)
-            if delta != 0:
-                for _ in range(abs(delta)):
-                    target_samples_for_class_c[random.randrange(num_clients)] += np.sign(delta)
-            
-            current_idx_in_class_c = 0
-            for client_id in range(num_clients):
-                num_samples_for_client = target_samples_for_class_c[client_id]
-                client_indices_map[client_id].extend(indices_c[current_idx_in_class_c : current_idx_in_class_c + num_samples_for_client])
-                current_idx_in_class_c += num_samples_for_client
+        partitions = dirichlet_partition(train_dataset_full.targets.numpy(), num_clients, non_iid_alpha,
+                                         min_size=10, cache_dir=os.path.join(data_path, 'partitions'),
+                                         refill='top_up')
+        for client_indices in partitions:
+            client_datasets_subsets.append(train_dataset_full.subset(client_indices))
 
-        for i in range(num_clients):
-            # 确保不存在空数据子集
-            if not client_indices_map[i] or len(client_indices_map[i]) < min_size_per_client :
-                current_client_indices = client_indices_map[i]
-                needed_samples = min_size_per_client - len(current_client_indices)
-                if needed_samples > 0:
-                    all_train_indices = list(range(len(train_dataset_full)))
-                    additional_indices = random.sample(all_train_indices, needed_samples)
-                    current_client_indices.extend(additional_indices)
-                client_datasets_subsets.append(Subset(train_dataset_full, list(set(current_client_indices))[:min_size_per_client*2])) # Use set to remove duplicates if any, and cap size
-            else:
-                client_datasets_subsets.append(Subset(train_dataset_full, client_indices_map[i]))
-
-    # 创建数据加载器
+    # 创建批迭代器（切片预加载张量，不启动 worker 进程）
     train_data_loaders = []
     for client_subset in client_datasets_subsets:
         if len(client_subset) > 0:
-             train_data_loaders.append(DataLoader(client_subset, batch_size=client_batch_size, shuffle=True, num_workers=os.cpu_count(), pin_memory=False)) # num_workers=0 for simplicity with small datasets
+             train_data_loaders.append(TensorBatchIterator(client_subset, client_batch_size, shuffle=True, device=DEVICE))
         else:
-             print(f"Warning: Client dataset subset is empty. Skipping DataLoader creation for this client.")
+             print(f"Warning: Client dataset subset is empty. Skipping batch iterator creation for this client.")
     
-    test_loader_local = DataLoader(test_dataset_full, batch_size=test_batch_size, shuffle=False, num_workers=os.cpu_count(), pin_memory=False)
+    test_loader_local = TensorBatchIterator(test_dataset_full, test_batch_size, shuffle=False, device=DEVICE)
     return train_data_loaders, test_loader_local
 
 
-# 模型训练函数
-def train_client_model(model, data_loader, epochs, lr, device):
+# 模型训练函数 (传入 optimizer 时复用调用方常驻的优化器)
+def train_client_model(model, data_loader, epochs, lr, device, optimizer=None):
     model.train()
-    optimizer = optim.SGD(model.parameters(), lr=lr)
+    if optimizer is None: optimizer = optim.SGD(model.parameters(), lr=lr)
     for epoch in range(epochs):
         for data, target in data_loader:
             data, target = data.to(device), target.to(device)
@@ -167,18 +143,23 @@ def flatten_params(model_state_dict):
     return torch.cat([p.view(-1) for p in model_state_dict.values()])
 
 
-# 还原模型参数
+# 还原模型参数：返回 flat_params 的视图，调用方需持有 flat_params 的所有权
 def unflatten_params(flat_params, target_model_state_dict_template):
-    new_state_dict = copy.deepcopy(target_model_state_dict_template)
-    current_pos = 0
-    for key in new_state_dict:
-        param = new_state_dict[key]
+    new_state_dict, current_pos = OrderedDict(), 0
+    for key, param in target_model_state_dict_template.items():
         num_elements = param.numel()
-        new_state_dict[key] = flat_params[current_pos : current_pos + num_elements].view_as(param).clone()
+        new_state_dict[key] = flat_params[current_pos : current_pos + num_elements].view_as(param)
         current_pos += num_elements
     return new_state_dict
 
 
+# 将参数字典原地拷贝进已有模型 (不重新构造模块、不分配新的参数张量)
+def load_state_in_place(model, state_dict):
+    with torch.no_grad():
+        for key, tensor in model.state_dict().items():
+            tensor.copy_(state_dict[key])
+
+
 # 计算参数变化量
 def calculate_update_delta(old_state_dict, new_state_dict, device):
     old_flat = flatten_params(old_state_dict).to(device)
@@ -194,11 +175,13 @@ class Participant:
         self.device = device        
         self.current_model_state = None         # 当前模型状态
         self.current_update_flat = None         # 上一次更新的扁平化参数
+        self.model = None                       # 常驻本地模型，首次训练时构造
+        self.optimizer = None                   # 常驻优化器，与本地模型同生命周期
 
 
-    # 设置当前模型状态
+    # 设置当前模型状态：全局状态只读共享，不做拷贝 (服务器聚合时整体替换状态字典，而非原地修改)
     def set_model_state(self, global_model_state):
-        self.current_model_state = copy.deepcopy(global_model_state)
+        self.current_model_state = global_model_state
 
 
     # 获取当前更新
@@ -206,6 +189,15 @@ class Participant:
         return self.current_update_flat
 
 
+    # 取得常驻本地模型并原地载入全局参数；模型和优化器只在首次调用时构造
+    def load_local_model(self, global_model_state_dict):
+        if self.model is None:
+            self.model = MLP().to(self.device)
+            self.optimizer = optim.SGD(self.model.parameters(), lr=self.lr)
+        load_state_in_place(self.model, global_model_state_dict)
+        return self.model
+
+
 # 诚实客户端
 class HonestClient(Participant):
     def __init__(self, id, data_loader, epochs, lr, device):
@@ -218,10 +210,9 @@ class HonestClient(Participant):
     # 计算更新
     def compute_update(self, global_model_state_dict):
         self.set_model_state(global_model_state_dict)
-        local_model = MLP().to(self.device)
-        local_model.load_state_dict(copy.deepcopy(global_model_state_dict))
+        local_model = self.load_local_model(global_model_state_dict)
         
-        trained_local_state_dict = train_client_model(local_model, self.data_loader, self.epochs, self.lr, self.device)
+        trained_local_state_dict = train_client_model(local_model, self.data_loader, self.epochs, self.lr, self.device, self.optimizer)
         
         self.current_update_flat = calculate_update_delta(global_model_state_dict, trained_local_state_dict, self.device)
         return self.current_update_flat
@@ -248,13 +239,15 @@ class FreeRider(Participant):
         self.attack_phase = "initial_hibernation"
         self.last_global_update_for_scaled_delta_flat = None
         self.second_last_global_update_for_scaled_delta_flat = None
+        self.last_global_update_norm = None
+        self.second_last_global_update_norm = None
         self.expected_cos_beta_history = []
     
 
-    # 更新历史全局模型梯度的l2范数
+    # 更新历史全局模型梯度的l2范数 (取自历史缓冲区的缓存)
     def _update_estimation_history(self, server_g_t_flat_history):
         if server_g_t_flat_history and len(server_g_t_flat_history) > 0:
-            g_t_norm = torch.linalg.norm(server_g_t_flat_history[-1]).item()
+            g_t_norm = server_g_t_flat_history.norm(-1).item()
             self.global_model_norm_diff_history_for_estimation.append(g_t_norm)
 
 
@@ -294,9 +287,11 @@ class FreeRider(Participant):
         # 处理服务器最近两次更新梯度
         if server_g_t_flat_history:
             if len(server_g_t_flat_history) >= 1:
-                self.last_global_update_for_scaled_delta_flat = server_g_t_flat_history[-1].clone().to(self.device)
+                self.last_global_update_for_scaled_delta_flat = server_g_t_flat_history[-1].to(self.device)
+                self.last_global_update_norm = server_g_t_flat_history.norm(-1)
             if len(server_g_t_flat_history) >= 2:
-                self.second_last_global_update_for_scaled_delta_flat = server_g_t_flat_history[-2].clone().to(self.device)
+                self.second_last_global_update_for_scaled_delta_flat = server_g_t_flat_history[-2].to(self.device)
+                self.second_last_global_update_norm = server_g_t_flat_history.norm(-2)
 
         fabricated_update_flat = None
         # 扁平化全局模型参数
@@ -313,15 +308,14 @@ class FreeRider(Participant):
 
         if self.attack_phase == "parameter_estimation":
             # print(f"INFO: Free-rider {self.id} (Round {current_round_num + 1}) is in 'parameter_estimation' phase - performing normal training.")
-            local_model = MLP().to(self.device)
-            local_model.load_state_dict(copy.deepcopy(global_model_state_dict))
-            trained_local_state_dict = train_client_model(local_model, self.data_loader, self.epochs, self.lr, self.device)
+            local_model = self.load_local_model(global_model_state_dict)
+            trained_local_state_dict = train_client_model(local_model, self.data_loader, self.epochs, self.lr, self.device, self.optimizer)
             fabricated_update_flat = calculate_update_delta(global_model_state_dict, trained_local_state_dict, self.device)
 
         elif self.attack_phase == "advanced_attack":
             # print(f"INFO: Free-rider {self.id} (Round {current_round_num + 1}) is in 'advanced_attack' phase - crafting update.")
-            norm_g_current = torch.linalg.norm(self.last_global_update_for_scaled_delta_flat)
-            norm_g_previous = torch.linalg.norm(self.second_last_global_update_for_scaled_delta_flat)
+            norm_g_current = self.last_global_update_norm
+            norm_g_previous = self.second_last_global_update_norm
 
             scaled_delta_factor = 1.0
             if norm_g_previous > 1e-9:
@@ -332,7 +326,7 @@ class FreeRider(Participant):
 
             # 计算缩放后的更新
             U_f_flat = scaled_delta_factor * self.last_global_update_for_scaled_delta_flat
-            norm_U_f_flat = torch.linalg.norm(U_f_flat)
+            norm_U_f_flat = scaled_delta_factor * norm_g_current # 缩放因子非负，范数由缓存值直接得到
 
             # 计算cosine_beta
             expected_cos_beta = self._calculate_expected_cosine_beta(current_round_num)
@@ -392,13 +386,14 @@ class FreeRider(Participant):
                 self.expected_cos_beta_history[current_round_num] = np.nan
 
 
-        self.current_update_flat = fabricated_update_flat.detach().clone()
+        self.current_update_flat = fabricated_update_flat.detach() # 本轮新生成的张量，直接转移所有权
         return self.current_update_flat
 
 
 # 服务器类
 class Server:
-    def __init__(self, initial_model_state_dict, honest_clients, free_riders, test_loader, device):
+    def __init__(self, initial_model_state_dict, honest_clients, free_riders, test_loader, device,
+                 sketch_dim=None, sketch_method="count_sketch", sketch_seed=RANDOM_SEED):
         self.global_model_state_dict = copy.deepcopy(initial_model_state_dict)
         self.honest_clients = honest_clients
         self.free_riders = free_riders
@@ -406,10 +401,11 @@ class Server:
         random.shuffle(self.all_clients)
         self.test_loader = test_loader
         self.device = device
+        self.eval_model = MLP().to(device) # 常驻评估模型，每轮原地载入全局参数
         
         self.global_model_test_accuracies = []
         self.global_model_test_losses = []
-        self.server_g_t_flat_history = []
+        self.server_g_t_flat_history = UpdateHistoryBuffer(GLOBAL_HISTORY_CAPACITY, device)
         
         self.stats_honest_l2_norms = [] 
         self.stats_freerider_l2_norms = []
@@ -422,6 +418,13 @@ class Server:
         self.stats_l2_norm_of_avg_honest_update = [] 
         self.stats_std_of_avg_honest_update = []     
 
+        # 草图模式：更新在提交时投影到 k 维，各项统计量均基于草图
+        self.sketcher = None
+        if sketch_dim:
+            num_params = flatten_params(self.global_model_state_dict).numel()
+            self.sketcher = UpdateSketcher(num_params, sketch_dim, sketch_method, sketch_seed, device=device)
+            print(f"Update sketching: {sketch_method}, k={sketch_dim}, inner-product error bound eps={self.sketcher.error_bound:.4f}")
+
 
     # 聚合客户端更新，采用简单的FedAvg方法
     def aggregate_updates(self, client_updates_flat, client_weights=None):
@@ -431,14 +434,13 @@ class Server:
         if client_weights is None:
             client_weights = [1.0 / len(client_updates_flat)] * len(client_updates_flat)
         
-        aggregated_update_flat = torch.zeros_like(client_updates_flat[0], device=self.device)
-        for weight, update_flat in zip(client_weights, client_updates_flat):
-            aggregated_update_flat += weight * update_flat
+        # [k, d] 更新矩阵乘以权重向量 (与 Requester 的聚合共用同一实现)，结果直接写入历史缓冲区的下一个槽位
+        aggregated_update_flat = self.server_g_t_flat_history.next_slot(client_updates_flat[0]).zero_()
+        weighted_update_sum(client_updates_flat, client_weights, out=aggregated_update_flat)
+        self.server_g_t_flat_history.commit()
         
         current_global_flat = flatten_params(self.global_model_state_dict).to(self.device)
         new_global_flat = current_global_flat + aggregated_update_flat
-        
-        self.server_g_t_flat_history.append(aggregated_update_flat.detach().clone())
 
         self.global_model_state_dict = unflatten_params(new_global_flat, self.global_model_state_dict)
         return self.global_model_state_dict
@@ -452,13 +454,13 @@ class Server:
 
         for client in self.all_clients:
             if client.type == "honest":
-                update_flat = client.compute_update(copy.deepcopy(self.global_model_state_dict))
+                update_flat = client.compute_update(self.global_model_state_dict)
                 client_updates_flat_this_round.append(update_flat)
                 honest_client_updates_this_round.append(update_flat)
             elif client.type == "free_rider":
                 num_total_clients = len(self.all_clients)
                 update_flat = client.compute_update(current_round_num, 
-                                                    copy.deepcopy(self.global_model_state_dict),
+                                                    self.global_model_state_dict,
                                                     self.server_g_t_flat_history,
                                                     num_total_clients)
                 client_updates_flat_this_round.append(update_flat)
@@ -472,57 +474,42 @@ class Server:
 
         self.aggregate_updates(client_updates_flat_this_round)
 
-        temp_model_for_test = MLP().to(self.device)
-        temp_model_for_test.load_state_dict(self.global_model_state_dict)
-        accuracy, loss = test_model(temp_model_for_test, self.test_loader, self.device)
+        load_state_in_place(self.eval_model, self.global_model_state_dict)
+        accuracy, loss = test_model(self.eval_model, self.test_loader, self.device)
         self.global_model_test_accuracies.append(accuracy)
         self.global_model_test_losses.append(loss)
         print(f"Global Model Accuracy: {accuracy:.2f}%, Loss: {loss:.4f}")
 
-        round_honest_l2, round_fr_l2 = [], []
-        round_honest_std, round_fr_std = [], []
-        
-        for update in honest_client_updates_this_round:
-            round_honest_l2.append(torch.linalg.norm(update).item())
-            round_honest_std.append(torch.std(update).item())
-        
-        for update in freerider_client_updates_this_round:
-            round_fr_l2.append(torch.linalg.norm(update).item())
-            round_fr_std.append(torch.std(update).item())
-            
-        self.stats_honest_l2_norms.append(round_honest_l2)
-        self.stats_freerider_l2_norms.append(round_fr_l2)
-        self.stats_honest_stds.append(round_honest_std)
-        self.stats_freerider_stds.append(round_fr_std)
-
-        avg_honest_update_flat = None
-        if honest_client_updates_this_round:
-            avg_honest_update_flat = torch.stack(honest_client_updates_this_round).mean(dim=0)
-            self.stats_l2_norm_of_avg_honest_update.append(torch.linalg.norm(avg_honest_update_flat).item())
-            self.stats_std_of_avg_honest_update.append(torch.std(avg_honest_update_flat).item())
+        # 堆叠为 [n, d] 更新矩阵，范数、标准差及与诚实均值更新的余弦一次批量算出
+        num_honest = len(honest_client_updates_this_round)
+        round_updates = honest_client_updates_this_round + freerider_client_updates_this_round
+        round_stats = None
+        if round_updates and self.sketcher is not None:
+            # 行和在提交时精确计算 (O(d) 一次)，其余统计只用 [n, k] 草图
+            round_sketches = self.sketcher.sketch(torch.stack([u.to(self.device) for u in round_updates]))
+            round_stats = update_statistics(round_sketches, reference_mask=[i < num_honest for i in range(len(round_updates))],
+                                            dim=self.sketcher.dim, sums=torch.stack([u.sum() for u in round_updates]).to(self.device))
+        elif round_updates:
+            round_stats = update_statistics(torch.stack([u.to(self.device) for u in round_updates]),
+                                            reference_mask=[i < num_honest for i in range(len(round_updates))])
+        norms = round_stats["norms"].tolist() if round_stats else []
+        stds = round_stats["stds"].tolist() if round_stats else []
+
+        self.stats_honest_l2_norms.append(norms[:num_honest])
+        self.stats_freerider_l2_norms.append(norms[num_honest:])
+        self.stats_honest_stds.append(stds[:num_honest])
+        self.stats_freerider_stds.append(stds[num_honest:])
+
+        if num_honest > 0:
+            self.stats_l2_norm_of_avg_honest_update.append(round_stats["mean_norm"].item())
+            self.stats_std_of_avg_honest_update.append(round_stats["mean_std"].item() if round_stats["mean_std"] is not None else np.nan)
         else:
             self.stats_l2_norm_of_avg_honest_update.append(np.nan)
             self.stats_std_of_avg_honest_update.append(np.nan)
 
-        current_round_honest_to_avg_sims = []
-        if avg_honest_update_flat is not None and torch.linalg.norm(avg_honest_update_flat) > 1e-9:
-            for honest_update in honest_client_updates_this_round:
-                if torch.linalg.norm(honest_update) > 1e-9: 
-                    sim = torch.nn.functional.cosine_similarity(honest_update, avg_honest_update_flat, dim=0).item()
-                    current_round_honest_to_avg_sims.append(sim)
-                else:
-                    current_round_honest_to_avg_sims.append(0.0) 
-        self.stats_honest_to_avg_honest_cosine_sims.append(current_round_honest_to_avg_sims)
-
-        current_round_freerider_to_avg_sims = []
-        if avg_honest_update_flat is not None and torch.linalg.norm(avg_honest_update_flat) > 1e-9:
-            for fr_update in freerider_client_updates_this_round:
-                if torch.linalg.norm(fr_update) > 1e-9:
-                    sim = torch.nn.functional.cosine_similarity(fr_update, avg_honest_update_flat, dim=0).item()
-                    current_round_freerider_to_avg_sims.append(sim)
-                else:
-                    current_round_freerider_to_avg_sims.append(0.0) 
-        self.stats_freerider_to_avg_honest_cosine_sims.append(current_round_freerider_to_avg_sims)
+        mean_cosines = round_stats["mean_cosine"].tolist() if round_stats and round_stats["mean_cosine"] is not None else []
+        self.stats_honest_to_avg_honest_cosine_sims.append(mean_cosines[:num_honest])
+        self.stats_freerider_to_avg_honest_cosine_sims.append(mean_cosines[num_honest:])
 
 
 # 设置随机种子，确保实验可重复
@@ -573,7 +560,8 @@ if __name__ == "__main__":
         for i in range(NUM_FREE_RIDERS)
     ]
 
-    server = Server(initial_model.state_dict(), honest_clients_list, free_riders_list, test_loader, DEVICE)
+    server = Server(initial_model.state_dict(), honest_clients_list, free_riders_list, test_loader, DEVICE,
+                    sketch_dim=UPDATE_SKETCH_DIM, sketch_method=UPDATE_SKETCH_METHOD)
 
     for r in range(NUM_ROUNDS):
         server.run_fl_round(r)
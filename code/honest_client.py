@@ -1,19 +1,23 @@
 from system import Participant
-from torch.utils.data import DataLoader, random_split
+from data_cache import TensorBatchIterator
 import torch
 import torch.optim as optim
 import torch.nn as nn
 import random
-import os # 用于获取 CPU 核心数
+from collections import deque
 
 class HonestClient(Participant):
+    # 并行执行时由工作进程回传给主进程的轮次状态
+    round_state_fields = ("perf_before_local_train", "perf_after_local_train")
+
     def __init__(self, id, init_rep, tra_round_num, device,
                  client_dataset, train_size, batch_size, local_epochs, lr,
                  init_commit_scaling_factor,
                  adapt_bid_adj_intensity,
                  adapt_bid_max_delta,
                  min_commit_scaling_factor,
-                 commit_decay_rate=0.9
+                 commit_decay_rate=0.9,
+                 improvement_window=3
                 ):
         # 初始化父类
         super().__init__(id, "honest_client", init_rep, tra_round_num, device)
@@ -24,13 +28,14 @@ class HonestClient(Participant):
         else:
             train_len = int(len(self.dataset) * train_size)
             val_len = len(self.dataset) - train_len
-            self.train_subset, self.val_subset = random_split(self.dataset, [train_len, val_len])
-        # 初始化数据加载器
-        pin_memory_flag = self.device != torch.device("cpu")
-        num_workers_val = os.cpu_count()
+            self.train_subset, self.val_subset = self.dataset.random_split([train_len, val_len])
+        # 初始化批迭代器（直接切片预加载张量，不启动 worker 进程）
+        # 每个客户端独立的随机数生成器，使串行/批量训练得到相同的批次顺序
         self.batch_size = batch_size
-        self.train_loader = DataLoader(self.train_subset, batch_size=batch_size, shuffle=True, pin_memory=pin_memory_flag, num_workers=num_workers_val, persistent_workers=True if num_workers_val > 0 else False)
-        self.val_loader = DataLoader(self.val_subset, batch_size=batch_size, shuffle=False, pin_memory=pin_memory_flag, num_workers=num_workers_val, persistent_workers=True if num_workers_val > 0 else False)
+        self.generator = torch.Generator().manual_seed(int(torch.randint(2**62, (1,)).item()))
+        self.train_loader = TensorBatchIterator(self.train_subset, batch_size, shuffle=True, device=self.device, generator=self.generator)
+        self.val_loader = TensorBatchIterator(self.val_subset, batch_size, shuffle=False, device=self.device)
+        self.full_loader = TensorBatchIterator(self.dataset, batch_size, shuffle=False, device=self.device)
         # 初始化训练参数
         self.local_epochs, self.lr = local_epochs, lr
         self.criterion = nn.CrossEntropyLoss()
@@ -44,19 +49,26 @@ class HonestClient(Participant):
         self.adapt_bid_max_delta = float(adapt_bid_max_delta)               # 适应性承诺最大调整增量
         self.min_commit_scaling_factor = float(min_commit_scaling_factor)   # 最小承诺缩放因子
         self.commit_decay_rate = float(commit_decay_rate)                   # 承诺衰减率
+        self.improvement_history = deque(maxlen=improvement_window)         # 最近几次本地训练实际带来的性能提升
+        self.predicted_increase = None                                      # 本轮投标所用的预测提升 (先投标后训练时)
     
 
+    # 被淘汰后连同优化器和批迭代器一起释放
+    def release_resources(self):
+        super().release_resources()
+        self.optimizer = None
+        self.train_loader, self.val_loader, self.full_loader = None, None, None
+
+
     # 评估模型
     def evaluate_model(self, on_val_set=False):
         if self.model is None: return 0.0, float('inf')
         self.model.eval()
-        # 修改 num_workers = 0
-        loader = DataLoader(self.dataset, batch_size=self.batch_size, shuffle=False, num_workers=0, pin_memory=self.device != torch.device("cpu")) if on_val_set else self.val_loader
+        loader = self.full_loader if on_val_set else self.val_loader
         if not loader or len(loader.dataset) == 0: return 0.0, float('inf')
         total_loss, correct, total = 0.0, 0, 0
         with torch.no_grad():
             for inputs, labels in loader:
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
                 outputs = self.model(inputs)
                 loss = self.criterion(outputs, labels)
                 total_loss += loss.item() * inputs.size(0)
@@ -73,11 +85,11 @@ class HonestClient(Participant):
             self.perf_after_local_train = self.perf_before_local_train
             return self.model.state_dict() if self.model else None
         self.model.train()
+        # 优化器与本地模型同生命周期：参数始终是同一块连续缓冲区的视图，原地载入全局参数后无需重建
         # self.optimizer = optim.Adam(self.model.parameters(), lr=self.lr) 
-        self.optimizer = optim.SGD(self.model.parameters(), lr=self.lr)
+        if self.optimizer is None: self.optimizer = optim.SGD(self.model.parameters(), lr=self.lr)
         for epoch in range(self.local_epochs):
             for inputs, labels in self.train_loader:
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
                 self.optimizer.zero_grad()
                 outputs = self.model(inputs)
                 loss = self.criterion(outputs, labels)
@@ -89,16 +101,29 @@ class HonestClient(Participant):
 
     # 提交真实更新
     def gen_true_update(self, current_global_model_state):
-        local_model_params = self._flatten_params(self.model.state_dict())
+        local_model_params = self.model.flat_params
         global_model_params = self._flatten_params(current_global_model_state)
         local_update = local_model_params - global_model_params
         self.current_update = self._unflatten_params(local_update, current_global_model_state)
         return self.current_update
 
 
-    # 投标
-    def submit_bid(self):
-        raw_promised_increase = self.perf_after_local_train - self.perf_before_local_train
+    # 记录本轮本地训练实际带来的性能提升
+    def record_improvement(self):
+        self.improvement_history.append(self.perf_after_local_train - self.perf_before_local_train)
+
+
+    # 由自身历史预测下一次训练的性能提升 (最近几次提升的均值)；尚无历史时返回 None
+    def predict_improvement(self):
+        if not self.improvement_history: return None
+        return sum(self.improvement_history) / len(self.improvement_history)
+
+
+    # 投标：给定 predicted_increase 时按预测提升承诺 (先投标后训练)，否则按本轮训练实际得到的提升承诺
+    def submit_bid(self, predicted_increase=None):
+        self.predicted_increase = predicted_increase
+        if predicted_increase is None: raw_promised_increase = self.perf_after_local_train - self.perf_before_local_train
+        else: raw_promised_increase = predicted_increase
         self.bid['promise'] = raw_promised_increase * self.init_commit_scaling_factor
         self.bid['reward'] = float(self.local_epochs * random.uniform(1.00, 1.25))
         return self.bid
@@ -1,14 +1,16 @@
-from system import get_mnist_data, Global_Model, Requester
+from system import get_mnist_data, Global_Model, Requester, ParticipantRegistry, flatten_state
+from data_cache import MNIST_DATA_ROOT
 from honest_client import HonestClient
 from free_rider import FreeRider
+from batched_training import train_clients_batched
+from parallel_clients import ParallelRoundExecutor
+from client_evaluation import ClientDataEvaluator
+from testset_evaluation import HeldOutEvaluator
+from update_stats import update_statistics, UpdateSketcher
 import torch
 import random
 import numpy as np
-import copy
-from torch.utils.data import DataLoader
-import torch.nn.functional as F
 import json
-import os
 
 class Simulation:
     def __init__(self, params_X):
@@ -24,6 +26,8 @@ class Simulation:
         self.initial_M_t = params_X.get("initial_M_t", self.num_total_participants // 2) # 初始每轮选择的参与者数量
         self.iid_data_distribution = params_X.get("iid_data", True) # 数据是否独立同分布
         self.non_iid_alpha = params_X.get("non_iid_alpha", 0.3) # Non-IID 数据分布的参数
+        self.data_root = params_X.get("data_root", MNIST_DATA_ROOT) # MNIST 数据及张量缓存目录
+        self.partition_seed = params_X.get("partition_seed", None) # Non-IID 划分种子 (同时作为划分缓存的键；为 None 时不写磁盘缓存)
 
         self.alpha_reward = params_X.get("alpha_reward") # 奖励计算参数 alpha
         self.beta_penalty_base = params_X.get("beta_penalty_base") # 惩罚计算参数 beta
@@ -46,8 +50,32 @@ class Simulation:
         self.local_epochs_honest = params_X.get("local_epochs_honest", 2)
         self.lr_honest = params_X.get("lr_honest", 0.005)
         self.batch_size_honest = params_X.get("batch_size_honest", 32)
+        self.batched_local_train = params_X.get("batched_local_train", False) # 是否用 vmap 批量同步训练所有诚实客户端 (仅串行模式，不能与 num_client_workers > 0 同时开启)
+        self.batched_client_chunk_size = params_X.get("batched_client_chunk_size", None) # 批量训练时每组客户端数 (None 表示全部)
+        self.num_client_workers = params_X.get("num_client_workers", 0) # 并行执行参与者的工作进程数 (0 表示串行)
+        self.threads_per_client_worker = params_X.get("threads_per_client_worker", None) # 每个工作进程的 torch 线程数
+        self.verification_mode = params_X.get("verification_mode", "serial") # 验证方式: "serial" 逐个评估, "stacked" 堆叠候选单次评估, "sequential" 序贯提前停止, "group" 分组检验 (平均更新未达标时二分)
+        self.verification_chunk_size = params_X.get("verification_chunk_size", None) # 堆叠验证时每次前向的候选数上限
+        self.verification_failure_prob = params_X.get("verification_failure_prob", 0.05) # 序贯验证 (verification_mode="sequential") 的判定失败概率上限
+        self.test_batch_size = params_X.get("test_batch_size", 2048) # Requester 评估测试集时的批大小
+        self.verification_batch_size = params_X.get("verification_batch_size", 512) # 序贯验证每次检查前的样本数
+        self.screening_loss_threshold = params_X.get("screening_loss_threshold", None) # 一阶筛查阈值: 预测测试损失增量超过该值的更新不做完整验证 (None 表示关闭)
+        self.verification_coreset_size = params_X.get("verification_coreset_size", None) # 紧凑验证集 (核心集) 样本数，逐个/分组验证在其上进行 (None 表示使用完整测试集)
+        self.coreset_build_version = params_X.get("coreset_build_version", 1) # 全局模型聚合达到该次数后构建核心集
+        self.group_attribution_margin = params_X.get("group_attribution_margin", None) # 分组检验: None 时通过组的成员逐个复验；给定时份额超出 promise 该值的成员按一阶归属判定 (不加声誉)
+        self.update_sketch_dim = params_X.get("update_sketch_dim", None) # 更新草图维度 k (None 表示统计量在完整更新上计算)
+        self.update_sketch_method = params_X.get("update_sketch_method", "count_sketch") # 草图方法: "count_sketch" 或 "jl"
+        self.update_sketch_seed = params_X.get("update_sketch_seed", 0) # 草图投影的随机种子
+        self.update_sketch_failure_prob = params_X.get("update_sketch_failure_prob", 0.05) # 草图误差界的失败概率
+        self.round_protocol = params_X.get("round_protocol", "train_first") # 轮次协议: "train_first" 全部训练后投标, "bid_first" 按预测提升投标、只有中标者训练
+        self.batched_client_evaluation = params_X.get("batched_client_evaluation", True) # 本轮开始时是否把所有诚实客户端对全局模型的评估合并为一次前向
+        self.client_evaluation_batch_size = params_X.get("client_evaluation_batch_size", 4096) # 合并评估时的批大小
+        self.client_evaluator = None
+        self.client_executor = None
+        self.update_sketcher = None
 
         self.participants = []
+        self.registry = None # 参与者的结构数组注册表 (声誉/投标/选中状态等)
         self.requester = None
         self.current_round = 0
         self.M_t = self.initial_M_t
@@ -58,9 +86,13 @@ class Simulation:
         
         self.client_l2_norm_history = {}
         self.client_cosine_similarity_history = {}
-        self.client_reputation_history = {} # main.py 级别的声誉历史记录，用于绘图或整体分析
+        # 每轮全部客户端的声誉记录 (可选)：预分配 [T_max + 1, N] 数组，第 t 行为第 t 轮结束后的声誉 (按 participants 顺序)
+        self.record_reputation_history = params_X.get("record_reputation_history", False)
+        self.reputation_history_array = None
+        self.update_sketch_history = [] # 草图模式下每轮各参与者更新的草图 [N, k] (按 participants 顺序，无更新的行为 NaN)
         self.client_types = {}
         self.all_fr_eliminated_logged = False
+        self.bid_prediction_records = [] # 先投标后训练时，被选中诚实客户端的预测提升、实际提升与验证结果
 
         # 新增：用于存储模拟过程中的统计数据
         self.simulation_stats = {
@@ -78,26 +110,42 @@ class Simulation:
     # 初始化环境，包括全局模型、数据加载器和参与者
     def initialize_environment(self):
         print("初始化环境中...")
+        # 工作进程内的参与者逐个执行 local_train，批量同步训练只在主进程串行模式下可用
+        if self.batched_local_train and self.num_client_workers > 0:
+            raise ValueError("batched_local_train 不能与 num_client_workers > 0 同时使用 (工作进程逐个训练客户端)")
         initial_global_model = Global_Model()
         effective_num_honest_clients = max(0, self.num_honest_clients)
 
         client_datasets, test_dataset_global = get_mnist_data(
-            effective_num_honest_clients, self.iid_data_distribution, self.non_iid_alpha
+            effective_num_honest_clients, self.iid_data_distribution, self.non_iid_alpha, self.data_root,
+            partition_seed=self.partition_seed
         )
         if effective_num_honest_clients > 0 and (not client_datasets or effective_num_honest_clients > len(client_datasets)):
             print(f"警告: 请求 {effective_num_honest_clients} 个诚实客户端数据，实际分配 {len(client_datasets)} 个。")
             if not client_datasets and effective_num_honest_clients > 0:
                  raise ValueError(f"诚实客户端数据分配失败: 请求 {effective_num_honest_clients}, 得到 {len(client_datasets)}")
 
-        pin_memory_flag = self.device != torch.device("cpu")
-        num_workers_val = os.cpu_count()
-        test_loader = DataLoader(test_dataset_global, batch_size=512, shuffle=False, 
-                                 pin_memory=pin_memory_flag, num_workers=num_workers_val)
-        
+        # 测试集一次性预加载到设备上，评估以大批次进行，不再为每次评估启动 DataLoader 工作进程
+        test_loader = HeldOutEvaluator.from_dataset(test_dataset_global, self.device, self.test_batch_size)
+
         self.requester = Requester(initial_global_model, test_loader, self.device,
                              alpha_reward=self.alpha_reward, 
-                             beta_penalty_base=self.beta_penalty_base)
+                             beta_penalty_base=self.beta_penalty_base,
+                             verification_mode=self.verification_mode,
+                             verification_chunk_size=self.verification_chunk_size,
+                             verification_failure_prob=self.verification_failure_prob,
+                             verification_batch_size=self.verification_batch_size,
+                             screening_loss_threshold=self.screening_loss_threshold,
+                             verification_coreset_size=self.verification_coreset_size,
+                             coreset_build_version=self.coreset_build_version,
+                             group_attribution_margin=self.group_attribution_margin)
         self.participants = []
+        if self.update_sketch_dim:
+            self.update_sketcher = UpdateSketcher(self.requester.global_model.flat_params.numel(), self.update_sketch_dim,
+                                                  self.update_sketch_method, self.update_sketch_seed,
+                                                  self.update_sketch_failure_prob, self.device)
+            print(f"更新草图: {self.update_sketch_method}, k = {self.update_sketch_dim}, "
+                  f"内积误差界 ε = {self.update_sketcher.error_bound:.4f} (失败概率 {self.update_sketch_failure_prob})")
         
         temp_participants = []
         for i in range(effective_num_honest_clients):
@@ -128,12 +176,18 @@ class Simulation:
         
         random.shuffle(temp_participants)
         self.participants = temp_participants
+        if self.batched_client_evaluation:
+            self.client_evaluator = ClientDataEvaluator(self.client_evaluation_batch_size, self.device)
+        if self.num_client_workers > 0 and self.participants:
+            self.client_executor = ParallelRoundExecutor(self.participants, self.num_client_workers, self.threads_per_client_worker)
+        self.registry = ParticipantRegistry(self.participants)
+        if self.record_reputation_history:
+            self.reputation_history_array = np.full((self.max_rounds + 1, len(self.participants)), np.nan)
 
         for p in self.participants:
             self.client_types[p.id] = p.type
             self.client_l2_norm_history[p.id] = []
             self.client_cosine_similarity_history[p.id] = []
-            self.client_reputation_history[p.id] = [] # 初始化为空列表，用于后续存储每轮声誉
 
         self.current_round = 0
         self.M_t = min(self.initial_M_t, len(self.participants)) if self.participants else 0
@@ -144,14 +198,14 @@ class Simulation:
         if self.requester: # 确保请求者已初始化
             self.final_global_model_performance, _ = self.requester.evaluate_global_model()
             if self.requester.global_model: # 确保全局模型存在
-                 self.requester.previous_global_model_state_flat = self.requester._flatten_params(self.requester.global_model.state_dict())
+                 self.requester.previous_global_model_state_flat = self.requester.global_model.flat_params.detach().clone()
             print(f"初始全局模型性能: {self.final_global_model_performance:.4f}")
             
             # 新增：记录初始状态 (第0轮) 的统计数据
             self.simulation_stats["round_number"].append(0)
             self.simulation_stats["model_accuracy"].append(self.final_global_model_performance)
-            initial_active_honest = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation >= self.reputation_threshold)
-            initial_active_free_riders = sum(1 for p in self.participants if self.client_types.get(p.id) == "free_rider" and p.reputation >= self.reputation_threshold)
+            initial_active_honest = int((self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
+            initial_active_free_riders = int((~self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
             self.simulation_stats["active_honest_clients"].append(initial_active_honest)
             self.simulation_stats["active_free_riders"].append(initial_active_free_riders)
             self.simulation_stats["M_t_value"].append(self.M_t) # 记录初始 M_t
@@ -160,11 +214,7 @@ class Simulation:
             self.simulation_stats["cumulative_tir_history"].append(0.0) # 初始TIR为0
 
             # 修改点：记录所有客户端在第0轮的初始声誉
-            for p_item in self.participants:
-                if p_item.id in self.client_reputation_history:
-                    self.client_reputation_history[p_item.id].append(p_item.reputation) # 此处 p_item.reputation 即为其初始声誉
-                else: # 理论上不应发生，因为上面循环中已为所有 participant 初始化了 key
-                    self.client_reputation_history[p_item.id] = [p_item.reputation]
+            self._record_reputations()
 
         else:
             self.final_global_model_performance = 0.0
@@ -183,12 +233,20 @@ class Simulation:
             self.simulation_stats["cumulative_real_incentive_cost"].append(0.0)
             self.simulation_stats["cumulative_tir_history"].append(0.0)
             # 修改点：即使初始化不完全，如果 participants 列表已形成，也尝试记录初始声誉
-            if self.participants:
-                for p_item in self.participants:
-                    if p_item.id in self.client_reputation_history:
-                        self.client_reputation_history[p_item.id].append(p_item.reputation)
-                    else:
-                        self.client_reputation_history[p_item.id] = [p_item.reputation]
+            self._record_reputations()
+
+
+    # 开启声誉记录时，把当前轮所有参与者的声誉写入预分配数组的一行
+    def _record_reputations(self):
+        if self.reputation_history_array is not None and self.registry is not None:
+            self.reputation_history_array[self.current_round] = self.registry.reputation
+
+
+    # 按客户端整理已记录的声誉历史 (JSON 格式与原先的 {id: [...]} 相同)；未开启记录时为 None
+    def client_reputation_history(self):
+        if self.reputation_history_array is None: return None
+        recorded = self.reputation_history_array[:self.current_round + 1]
+        return {p_id: recorded[:, slot].tolist() for slot, p_id in enumerate(self.registry.ids)}
 
 
     # 更新 M_t 值，根据当前参与者的声誉和更新情况
@@ -196,74 +254,184 @@ class Simulation:
         if self.current_round == 0 or not self.participants:
             return
 
-        active_participants = [p for p in self.participants if p.reputation >= self.reputation_threshold]
-        if not active_participants:
-            if not self.participants: self.M_t = 0
-            else: self.M_t = 1 
-            return
-
-        delta_reputations_map = {} 
-        delta_reputations_list = []
-        for p in active_participants:
-            if hasattr(p, 'get_delta_reputation'):
-                delta = p.get_delta_reputation()
-                delta_reputations_list.append(delta)
-                delta_reputations_map[p.id] = delta
-        
-        if not delta_reputations_list:
+        active_mask = self.registry.active_mask(self.reputation_threshold)
+        num_active = int(active_mask.sum())
+        if num_active == 0:
+            self.M_t = 1
             return
 
-        sorted_delta_r = sorted(delta_reputations_list, reverse=True)
-        
+        # 活跃参与者的声誉变化量降序排列；在 j > 1 的相邻间隔中取最大者 (并列取最靠前的)，k' = j + 1
+        sorted_delta_r = -np.sort(-self.registry.delta_reputation()[active_mask])
         k_prime_t_candidate = 1
-        if len(sorted_delta_r) > 1:
-            max_gap = -1.0
-            current_max_gap_idx = 0 
-            for j in range(len(sorted_delta_r) - 1):
-                gap = sorted_delta_r[j] - sorted_delta_r[j+1]
-                if gap > max_gap and j > 1: 
-                    max_gap = gap
-                    current_max_gap_idx = j 
-            k_prime_t_candidate = current_max_gap_idx + 1
-
-        elif len(sorted_delta_r) == 1:
-            k_prime_t_candidate = 1
-        else: 
-            return
+        if len(sorted_delta_r) > 3:
+            gaps = sorted_delta_r[2:-1] - sorted_delta_r[3:]
+            k_prime_t_candidate = 2 + int(np.argmax(gaps)) + 1
 
-        num_positive_delta_reps = sum(1 for dr in sorted_delta_r if dr > 1e-4) 
+        num_positive_delta_reps = int((sorted_delta_r > 1e-4).sum())
         final_k_prime_t = k_prime_t_candidate
-        
         if k_prime_t_candidate <= 1 and num_positive_delta_reps > 1:
-            final_k_prime_t = max(k_prime_t_candidate, min(num_positive_delta_reps, 3)) 
-        
-        final_k_prime_t = min(final_k_prime_t, len(active_participants)) 
-        final_k_prime_t = max(1, final_k_prime_t) 
+            final_k_prime_t = max(k_prime_t_candidate, min(num_positive_delta_reps, 3))
+        final_k_prime_t = max(1, min(final_k_prime_t, num_active))
 
         new_M_t_float = self.omega_m_update * self.M_t + (1 - self.omega_m_update) * final_k_prime_t
-        
         self.M_t = max(1, int(np.round(new_M_t_float)))
-        if active_participants: 
-             self.M_t = min(self.M_t, len(active_participants))
-        self.M_t = min(self.M_t, len(self.participants)) 
+        self.M_t = min(self.M_t, num_active, len(self.participants))
 
 
-    # 将梯度字典展平为一维张量
+    # 将梯度字典展平为一维张量 (留在原设备上；更新本身是连续缓冲区的视图时不复制)
     def _flatten_gradient_dict(self, gradient_dict):
         if gradient_dict is None or not isinstance(gradient_dict, dict):
             return None
         try:
-            flat_parts = []
-            for p_tensor in gradient_dict.values(): 
-                if isinstance(p_tensor, torch.Tensor):
-                    flat_parts.append(p_tensor.detach().view(-1).cpu())
+            flat_parts = {key: p_tensor.detach() for key, p_tensor in gradient_dict.items() if isinstance(p_tensor, torch.Tensor)}
             if not flat_parts: return None
-            return torch.cat(flat_parts)
+            return flatten_state(flat_parts)
         except Exception as e:
             print(f"Error flattening gradient dict: {e}")
             return None
 
 
+    # 指定参与者执行本轮本地计算：诚实客户端评估、训练并生成真实更新，搭便车者生成伪造更新
+    def _run_local_computation(self, participants_to_run, round_start_global_state):
+        honest_clients_to_train = []
+        if self.client_executor is not None:
+            # 并行模式：参与者分布在多个工作进程中执行，全局参数经共享内存广播
+            participant_ids = None if len(participants_to_run) == len(self.participants) else [p.id for p in participants_to_run]
+            self.client_executor.run_round(round_start_global_state, self.current_round,
+                                           self.requester.global_model_param_diff_history, len(self.participants),
+                                           participant_ids)
+        else:
+            # 合并评估：全局模型在所有待训练诚实客户端的本地数据上只前向一遍，准确率散回 perf_before_local_train
+            honest_to_run = [p for p in participants_to_run if p.type == "honest_client"]
+            if self.client_evaluator is not None and honest_to_run:
+                self.client_evaluator.evaluate(self.requester.global_model, honest_to_run)
+            for p in participants_to_run:
+                p.set_model_state(round_start_global_state)
+
+                if p.type == "honest_client":
+                    if self.client_evaluator is None: p.perf_before_local_train, _ = p.evaluate_model(on_val_set=True)
+                    if self.batched_local_train:
+                        honest_clients_to_train.append(p)
+                        continue
+                    p.local_train()
+                    p.gen_true_update(round_start_global_state)
+                else:
+                    p.gen_fabric_update(
+                        self.current_round,
+                        self.requester.global_model_param_diff_history,
+                        round_start_global_state,
+                        len(self.participants)
+                    )
+
+        # 批量模式：所有诚实客户端的本地 SGD 同步执行
+        if honest_clients_to_train:
+            train_clients_batched(honest_clients_to_train, self.batched_client_chunk_size)
+            for p in honest_clients_to_train:
+                p.gen_true_update(round_start_global_state)
+
+        for p in participants_to_run:
+            if p.type == "honest_client": p.record_improvement()
+
+
+    # 收集活跃参与者的投标；predictions 给出诚实客户端的预测提升时按预测投标 (值为 None 的按本轮实际提升投标)
+    def _collect_bids(self, predictions=None):
+        honest_bids_promises, honest_bids_rewards, honest_bids_ratios = [], [], []
+        num_bidding_honest_clients = 0
+        for p_bid in self.participants:
+            if p_bid.reputation < self.reputation_threshold:
+                p_bid.bid = {} 
+                continue
+            if p_bid.type == "honest_client":
+                bid_data = p_bid.submit_bid(predictions.get(p_bid.id) if predictions else None) 
+                if bid_data and 'promise' in bid_data and 'reward' in bid_data and bid_data['reward'] > 1e-6:
+                    honest_bids_promises.append(bid_data['promise'])
+                    honest_bids_rewards.append(bid_data['reward'])
+                    honest_bids_ratios.append(bid_data['promise'] / bid_data['reward'])
+                    num_bidding_honest_clients +=1
+        if num_bidding_honest_clients > 0 :
+            highest_honest_effectiveness = max(honest_bids_ratios)
+            lowest_honest_effectiveness = min(honest_bids_ratios)
+            lowest_honest_promise = min(honest_bids_promises) 
+            avg_honest_promise = np.mean(honest_bids_promises)
+            for p_fr_bid in self.participants: 
+                if p_fr_bid.reputation >= self.reputation_threshold and p_fr_bid.type == "free_rider":
+                    p_fr_bid.submit_bid(highest_honest_effectiveness, lowest_honest_effectiveness, lowest_honest_promise, avg_honest_promise)
+        else: 
+            for p_fr_bid_default in self.participants:
+                if p_fr_bid_default.reputation >= self.reputation_threshold and p_fr_bid_default.type == "free_rider":
+                    p_fr_bid_default.submit_bid(0,0,0,0) 
+
+
+    # 先投标后训练：诚实客户端按自身历史预测的提升投标，只有中标者执行本地训练或生成伪造更新
+    # 尚无训练历史的活跃诚实客户端先训练一次并按实际提升投标 (冷启动)
+    def _select_then_train(self, round_start_global_state, m_t_for_this_round):
+        active = [p for p in self.participants if p.reputation >= self.reputation_threshold]
+        for p in active:
+            if p.type == "free_rider": p.update_attack_state(self.current_round, self.requester.global_model_param_diff_history)
+        predictions = {p.id: p.predict_improvement() for p in active if p.type == "honest_client"}
+        bootstrap = [p for p in active if p.type == "honest_client" and predictions[p.id] is None]
+        if bootstrap: self._run_local_computation(bootstrap, round_start_global_state)
+
+        self._collect_bids(predictions)
+        selected_participants = self.requester.select_participants(self.registry, m_t_for_this_round, self.reputation_threshold)
+        bootstrap_ids = {p.id for p in bootstrap}
+        winners_to_run = [p for p in selected_participants if p.id not in bootstrap_ids]
+        # 并行模式下即使没有中标者也要下发本轮任务，工作进程中的搭便车者需要观察全局更新历史
+        if winners_to_run or self.client_executor is not None:
+            self._run_local_computation(winners_to_run, round_start_global_state)
+        print(f"先投标后训练: 本轮 {len(bootstrap) + len(winners_to_run)}/{len(self.participants)} 个参与者执行本地计算 "
+              f"(冷启动 {len(bootstrap)})")
+        return selected_participants
+
+
+    # 记录被选中诚实客户端的预测提升与实际提升，并打印本轮预测误差与验证结果
+    def _record_bid_predictions(self, verification_outcomes):
+        round_records = []
+        for outcome in verification_outcomes:
+            par = self.registry.get(outcome["participant_id"])
+            if not par or par.type != "honest_client" or par.predicted_increase is None: continue
+            round_records.append({
+                "round": self.current_round,
+                "participant_id": par.id,
+                "predicted_increase": float(par.predicted_increase),
+                "realized_increase": float(par.perf_after_local_train - par.perf_before_local_train),
+                "observed_increase": float(outcome.get("observed_increase", 0)),
+                "successful_verification": bool(outcome["successful_verification"]),
+            })
+        if not round_records: return
+        self.bid_prediction_records.extend(round_records)
+        mae = np.mean([abs(r["predicted_increase"] - r["realized_increase"]) for r in round_records])
+        num_success = sum(r["successful_verification"] for r in round_records)
+        print(f"  预测投标: 平均绝对误差 {mae:.4f}, 验证成功 {num_success}/{len(round_records)}")
+
+
+    # 汇总投标预测误差与验证结果的关系：总体/验证成功/验证失败的平均绝对误差，以及高估与低估时的验证失败率
+    def bid_prediction_summary(self):
+        if not self.bid_prediction_records: return None
+        errors = np.array([r["predicted_increase"] - r["realized_increase"] for r in self.bid_prediction_records])
+        success = np.array([r["successful_verification"] for r in self.bid_prediction_records])
+        def mean_abs_error(mask): return float(np.abs(errors[mask]).mean()) if mask.any() else None
+        def failure_rate(mask): return float((~success[mask]).mean()) if mask.any() else None
+        return {
+            "num_predicted_bids": int(len(errors)),
+            "mean_abs_error": mean_abs_error(np.ones_like(success)),
+            "mean_abs_error_verified": mean_abs_error(success),
+            "mean_abs_error_failed": mean_abs_error(~success),
+            "failure_rate_over_predicted": failure_rate(errors > 0),
+            "failure_rate_under_predicted": failure_rate(errors <= 0),
+        }
+
+
+    # 声誉跌破阈值的参与者不会再投标或被选中：释放其模型、优化器和批迭代器 (并行模式下工作进程中的副本在下一轮释放)
+    def _release_eliminated_participants(self):
+        eliminated = np.flatnonzero(~self.registry.active_mask(self.reputation_threshold))
+        for slot in eliminated:
+            p = self.registry.participants[slot]
+            if not p.released:
+                p.release_resources()
+                print(f"  参与者 {p.id} 已被淘汰，释放其本地资源。")
+
+
     # 运行一轮模拟
     def run_one_round(self):
         self.current_round += 1
@@ -283,105 +451,68 @@ class Simulation:
             self.simulation_stats["cumulative_tir_history"].append(current_tir)
             return True 
 
-        round_start_global_state = copy.deepcopy(self.requester.global_model.state_dict())
+        # 本轮广播的全局参数：只读共享视图，聚合前不会被修改，参与者无需各自拷贝
+        round_start_global_state = self.requester.global_model.state_dict()
         round_start_global_accuracy, _ = self.requester.evaluate_global_model()
 
         all_client_gradient_info_for_stats = [] 
         client_updates_for_submission = {} 
 
+        if self.round_protocol == "bid_first":
+            selected_participants = self._select_then_train(round_start_global_state, m_t_for_this_round)
+        else:
+            # 已淘汰的参与者不再评估、训练或生成更新 (统计历史中记为 NaN)
+            active = [p for p in self.participants if p.reputation >= self.reputation_threshold]
+            self._run_local_computation(active, round_start_global_state)
+            self._collect_bids()
+            selected_participants = self.requester.select_participants(self.registry, m_t_for_this_round, self.reputation_threshold)
+
         for p in self.participants:
-            p.set_model_state(copy.deepcopy(round_start_global_state)) 
             flat_gradient_for_stats_calc = None
-            
-            if p.type == "honest_client":
-                p.perf_before_local_train, _ = p.evaluate_model(on_val_set=True)
-                p.local_train()
-                p.gen_true_update(round_start_global_state) 
-            else: 
-                p.gen_fabric_update(
-                    self.current_round,
-                    self.requester.global_model_param_diff_history,
-                    round_start_global_state, 
-                    len(self.participants)
-                )
-
-            if p.current_update: 
-                client_updates_for_submission[p.id] = copy.deepcopy(p.current_update)
-                flat_gradient_for_stats_calc = self._flatten_gradient_dict(p.current_update)
+            if p.current_update:
+                # 更新的所有权直接转交给提交队列，不再深拷贝
+                client_updates_for_submission[p.id], p.current_update = p.current_update, None
+                flat_gradient_for_stats_calc = self._flatten_gradient_dict(client_updates_for_submission[p.id])
             
             all_client_gradient_info_for_stats.append({
                 'id': p.id,
                 'type': self.client_types[p.id],
                 'gradient_flat': flat_gradient_for_stats_calc 
             })
+        # 草图模式：本轮所有更新堆叠为 [n, d] 后一次投影到 k 维，之后的统计与历史只使用草图
+        if self.update_sketcher is not None:
+            sketched_clients = [client_data for client_data in all_client_gradient_info_for_stats if client_data['gradient_flat'] is not None]
+            if sketched_clients:
+                round_sketches = self.update_sketcher.sketch(torch.stack([client_data['gradient_flat'].to(self.device) for client_data in sketched_clients]))
+                for client_data, sketch in zip(sketched_clients, round_sketches):
+                    client_data['gradient_flat'] = sketch
         
         l2_norms_this_round = {client_data['id']: np.nan for client_data in all_client_gradient_info_for_stats}
         cosine_sims_this_round = {client_data['id']: np.nan for client_data in all_client_gradient_info_for_stats}
         if self.current_round > self.num_honest_rounds_for_fr_estimation:
-            avg_honest_update_direction_for_sim = None
-            honest_normalized_gradients_for_avg_sim = []
-            for client_data in all_client_gradient_info_for_stats:
-                if client_data['type'] == "honest_client":
-                    flat_grad = client_data['gradient_flat']
-                    if flat_grad is not None and flat_grad.numel() > 0:
-                        norm_val = torch.linalg.norm(flat_grad).item() 
-                        if norm_val > 1e-9: 
-                            honest_normalized_gradients_for_avg_sim.append(flat_grad / norm_val)
-            if honest_normalized_gradients_for_avg_sim:
-                valid_tensors_for_stacking = [t for t in honest_normalized_gradients_for_avg_sim if t is not None and t.numel() > 0]
-                if valid_tensors_for_stacking:
-                    sum_normalized_honest_gradients = torch.sum(torch.stack(valid_tensors_for_stacking), dim=0)
-                    norm_of_sum = torch.linalg.norm(sum_normalized_honest_gradients)
-                    if norm_of_sum > 1e-9:
-                        avg_honest_update_direction_for_sim = sum_normalized_honest_gradients / norm_of_sum
-            for client_data in all_client_gradient_info_for_stats:
-                p_id = client_data['id']
-                flat_grad = client_data['gradient_flat']
-                if flat_grad is not None and flat_grad.numel() > 0:
-                    l2_norms_this_round[p_id] = torch.linalg.norm(flat_grad).item()
-                    if avg_honest_update_direction_for_sim is not None:
-                        if flat_grad.shape == avg_honest_update_direction_for_sim.shape:
-                            try:
-                                cosine_sims_this_round[p_id] = F.cosine_similarity(
-                                    flat_grad.unsqueeze(0).float(), 
-                                    avg_honest_update_direction_for_sim.unsqueeze(0).float(), 
-                                    dim=1
-                                ).item()
-                            except Exception as e:
-                                print(f"计算余弦相似度时出错 (客户端 {p_id}, 轮次 {self.current_round}): {e}")
+            # 堆叠为 [n, d] 更新矩阵 (草图模式下为 [n, k])，一次批量计算范数及与 (归一化后) 诚实均值方向的余弦
+            stats_clients = [client_data for client_data in all_client_gradient_info_for_stats
+                             if client_data['gradient_flat'] is not None and client_data['gradient_flat'].numel() > 0]
+            if stats_clients:
+                round_stats = update_statistics(
+                    torch.stack([client_data['gradient_flat'].float() for client_data in stats_clients]),
+                    reference_mask=[client_data['type'] == "honest_client" for client_data in stats_clients],
+                    normalize_reference=True)
+                norms = round_stats["norms"].tolist()
+                cosines = round_stats["mean_cosine"].tolist() if round_stats["mean_cosine"] is not None else [np.nan] * len(norms)
+                for client_data, norm_val, cos_val in zip(stats_clients, norms, cosines):
+                    l2_norms_this_round[client_data['id']] = norm_val
+                    cosine_sims_this_round[client_data['id']] = cos_val
         for client_data in all_client_gradient_info_for_stats:
             p_id = client_data['id']
             self.client_l2_norm_history[p_id].append(l2_norms_this_round[p_id])
             self.client_cosine_similarity_history[p_id].append(cosine_sims_this_round[p_id])
+        if self.update_sketcher is not None:
+            round_sketches = torch.full((len(all_client_gradient_info_for_stats), self.update_sketch_dim), float('nan'))
+            for i, client_data in enumerate(all_client_gradient_info_for_stats):
+                if client_data['gradient_flat'] is not None: round_sketches[i] = client_data['gradient_flat'].cpu()
+            self.update_sketch_history.append(round_sketches)
 
-        honest_bids_promises, honest_bids_rewards, honest_bids_ratios = [], [], []
-        num_bidding_honest_clients = 0
-        for p_bid in self.participants:
-            if p_bid.reputation < self.reputation_threshold:
-                p_bid.bid = {} 
-                continue
-            if p_bid.type == "honest_client":
-                bid_data = p_bid.submit_bid() 
-                if bid_data and 'promise' in bid_data and 'reward' in bid_data and bid_data['reward'] > 1e-6:
-                    honest_bids_promises.append(bid_data['promise'])
-                    honest_bids_rewards.append(bid_data['reward'])
-                    honest_bids_ratios.append(bid_data['promise'] / bid_data['reward'])
-                    num_bidding_honest_clients +=1
-        if num_bidding_honest_clients > 0 :
-            highest_honest_effectiveness = max(honest_bids_ratios)
-            lowest_honest_effectiveness = min(honest_bids_ratios)
-            lowest_honest_promise = min(honest_bids_promises) 
-            avg_honest_promise = np.mean(honest_bids_promises)
-            for p_fr_bid in self.participants: 
-                if p_fr_bid.reputation >= self.reputation_threshold and p_fr_bid.type == "free_rider":
-                    p_fr_bid.submit_bid(highest_honest_effectiveness, lowest_honest_effectiveness, lowest_honest_promise, avg_honest_promise)
-        else: 
-            for p_fr_bid_default in self.participants:
-                if p_fr_bid_default.reputation >= self.reputation_threshold and p_fr_bid_default.type == "free_rider":
-                    p_fr_bid_default.submit_bid(0,0,0,0) 
-
-        selected_participants = self.requester.select_participants(self.participants, m_t_for_this_round, self.reputation_threshold) 
-        
         if not selected_participants:
             print("本轮没有参与者被选中。")
         else:
@@ -400,43 +531,44 @@ class Simulation:
                 )
                 
                 rewards_paid_ref = [self.total_rewards_paid] 
-                self.requester.update_reputations_and_pay(self.participants, verification_outcomes, rewards_paid_ref)
+                self.requester.update_reputations_and_pay(self.registry, verification_outcomes, rewards_paid_ref)
                 self.total_rewards_paid = rewards_paid_ref[0]
 
                 current_round_rewards_to_honest_clients_this_round = 0
                 for outcome in verification_outcomes: 
                     if outcome["successful_verification"]:
                         participant_id = outcome["participant_id"]
-                        participant = next((p_find for p_find in self.participants if p_find.id == participant_id), None)
+                        participant = self.registry.get(participant_id)
                         if participant and self.client_types.get(participant.id) == "honest_client":
                             reward_for_this_honest_client = participant.bid.get('reward', 0)
                             current_round_rewards_to_honest_clients_this_round += reward_for_this_honest_client
                 self.rewards_paid_to_honest_clients += current_round_rewards_to_honest_clients_this_round
                 
                 for outcome in verification_outcomes: 
-                    par = next((p_find for p_find in self.participants if p_find.id == outcome["participant_id"]), None)
+                    par = self.registry.get(outcome["participant_id"])
                     if par:
-                        status_str = "成功" if outcome["successful_verification"] else "失败"
+                        status_str = ("成功 (一阶归属)" if outcome.get("attributed_increase") else "成功") if outcome["successful_verification"] else ("一阶筛除" if outcome.get("screened_out") else "失败")
+                        error_str = f" (±{outcome['accuracy_error']:.3f})" if "accuracy_error" in outcome else "" # 核心集验证的准确率误差或序贯验证的置信半径
                         print(f"  - {par.id} ({self.client_types[par.id]}), 声誉: {par.reputation:.2f}, "
                               f"投标: P={par.bid.get('promise',0):.3f}/R={par.bid.get('reward',0):.2f}, "
-                              f"观察提升: {outcome.get('observed_increase',0):.3f}, 状态: {status_str}")
+                              f"观察提升: {outcome.get('observed_increase',0):.3f}{error_str}, 状态: {status_str}")
+                self._record_bid_predictions(verification_outcomes)
+                if self.verification_mode == "group":
+                    print(f"  分组检验: {len(updates_to_verify)} 个候选共评估测试集 {self.requester.last_verification_passes} 次")
         
-        for p_every in self.participants:
-            p_every.update_reputation_history() 
+        self.registry.push_reputation_history(np.arange(len(self.registry))) # 所有参与者的声誉窗口一次性前移
+        self._release_eliminated_participants()
 
-        for p_track in self.participants:
-            # 此处 p_track.id 必然在 self.client_reputation_history 中，
-            # 因为已在 initialize_environment 中为所有参与者添加了初始声誉
-            self.client_reputation_history[p_track.id].append(p_track.reputation) # 追加本轮结束后的声誉
+        self._record_reputations() # 记录本轮结束后的声誉
 
         self.requester.update_global_model_history() 
         self.final_global_model_performance, _ = self.requester.evaluate_global_model()
         
         self.update_M_t() 
         
-        num_active_total = sum(1 for p in self.participants if p.reputation >= self.reputation_threshold)
-        num_active_honest = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation >= self.reputation_threshold)
-        num_active_free_riders = sum(1 for p in self.participants if self.client_types.get(p.id) == "free_rider" and p.reputation >= self.reputation_threshold)
+        num_active_total = int(self.registry.active_mask(self.reputation_threshold).sum())
+        num_active_honest = int((self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
+        num_active_free_riders = int((~self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
         
         current_cumulative_tir = 0.0
         if self.total_rewards_paid > 1e-9:
@@ -475,19 +607,19 @@ class Simulation:
             self.termination_round = self.max_rounds 
             return True
         if self.num_honest_clients > 0 and self.current_round > 0: 
-            num_active_honest_val = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation >= self.reputation_threshold)
+            num_active_honest_val = int((self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
             if num_active_honest_val == 0:
                 print("没有活跃的诚实客户端了。模拟可能卡住或所有诚实客户端被错误惩罚。终止模拟。")
                 self.termination_round = self.current_round 
                 return True
         if self.current_round > 0: 
-            num_active_total_final_check_val = sum(1 for p in self.participants if p.reputation >= self.reputation_threshold)
+            num_active_total_final_check_val = int(self.registry.active_mask(self.reputation_threshold).sum())
             if num_active_total_final_check_val == 0: 
                 print("没有活跃的参与者了。终止模拟。")
                 self.termination_round = self.current_round
                 return True
         if self.num_free_riders > 0 and not self.all_fr_eliminated_logged: 
-            num_active_free_riders = sum(1 for p in self.participants if self.client_types.get(p.id) == "free_rider" and p.reputation >= self.reputation_threshold)
+            num_active_free_riders = int((~self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
             if num_active_free_riders == 0 and self.current_round > 0:
                 if self.target_accuracy_threshold is None: 
                     print("所有搭便车者已被清除 (且未设定目标准确率)。终止模拟。")
@@ -524,7 +656,7 @@ class Simulation:
         
         final_fpr = 0.0
         if self.num_honest_clients > 0 and self.participants: 
-            num_honest_eliminated = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation < self.reputation_threshold)
+            num_honest_eliminated = int((self.registry.is_honest & ~self.registry.active_mask(self.reputation_threshold)).sum())
             final_fpr = num_honest_eliminated / self.num_honest_clients
         elif self.num_honest_clients == 0 :
              final_fpr = 0.0 
@@ -544,9 +676,14 @@ class Simulation:
                 "num_total_participants_config": self.num_total_participants, # 总参与者数
                 "num_honest_clients_config": self.num_honest_clients, # 诚实客户端数
                 "num_free_riders_config": self.num_free_riders, # 搭便车者数
+                "update_sketch_error_bound": self.update_sketcher.error_bound if self.update_sketcher else None, # 草图统计的内积误差界 ε
             },
             "per_round_statistics": records, # 每轮统计数据
-            "client_reputation_over_rounds": self.client_reputation_history # 每个客户端在每轮的声誉历史
+            "client_reputation_over_rounds": self.client_reputation_history(), # 每个客户端在每轮的声誉历史 (需开启 record_reputation_history)
+            "bid_prediction_summary": self.bid_prediction_summary(), # 先投标后训练时预测误差与验证结果的汇总
+            "bid_prediction_records": self.bid_prediction_records, # 先投标后训练时每个被选中诚实客户端的预测/实际提升与验证结果
+            "update_sketch_participant_ids": [p.id for p in self.participants] if self.update_sketcher else None, # 草图行对应的参与者
+            "update_sketch_history": [round_sketches.tolist() for round_sketches in self.update_sketch_history] # 草图模式下每轮 [N, k] 更新草图 (无更新的行为 NaN)
         }
 
         try:
@@ -567,6 +704,13 @@ class Simulation:
                  print(f"使用备用序列化器保存统计数据仍然失败: {e_fallback}")
     
 
+    # 关闭并行执行参与者的工作进程
+    def close_client_executor(self):
+        if self.client_executor is not None:
+            self.client_executor.close()
+            self.client_executor = None
+
+
     # 运行模拟
     def run_simulation(self):
         try: 
@@ -574,7 +718,7 @@ class Simulation:
         except ValueError as e:
             print(f"模拟初始化失败: {e}")
             self.termination_round = 0 
-            # 即使初始化失败，如果 client_reputation_history 有部分数据（例如空的 client id 映射），也尝试保存
+            # 即使初始化失败，也尝试保存已有的统计数据
             self.save_simulation_stats(f"simulation_results_init_fail_N{self.num_total_participants}_Nf{self.num_free_riders}.json")
             return self.max_rounds, float('inf'), 1.0, 0.0, 0.0 
         
@@ -584,21 +728,25 @@ class Simulation:
              self.save_simulation_stats(f"simulation_results_start_fail_N{self.num_total_participants}_Nf{self.num_free_riders}.json")
              return self.max_rounds, float('inf'), 1.0, 0.0, 0.0
 
-        terminated = False
-        while not terminated:
-            terminated = self.run_one_round()
+        # 异常退出时同样关闭常驻工作进程并释放共享内存
+        try:
+            terminated = False
+            while not terminated:
+                terminated = self.run_one_round()
             
-            if not terminated and \
-               self.final_global_model_performance < self.min_performance_constraint * 0.5 and \
-               self.current_round > min(5, self.max_rounds / 4) and \
-               self.max_rounds > 5 :
-                print(f"全局模型性能 ({self.final_global_model_performance:.4f}) 过低 (低于约束 {self.min_performance_constraint*0.5:.4f}，用于帕累托优化场景)，提前终止。")
-                if self.termination_round == self.max_rounds: 
-                    self.termination_round = self.current_round
-                terminated = True 
+                if not terminated and \
+                   self.final_global_model_performance < self.min_performance_constraint * 0.5 and \
+                   self.current_round > min(5, self.max_rounds / 4) and \
+                   self.max_rounds > 5 :
+                    print(f"全局模型性能 ({self.final_global_model_performance:.4f}) 过低 (低于约束 {self.min_performance_constraint*0.5:.4f}，用于帕累托优化场景)，提前终止。")
+                    if self.termination_round == self.max_rounds: 
+                        self.termination_round = self.current_round
+                    terminated = True 
             
-            if terminated: 
-                break
+                if terminated: 
+                    break
+        finally:
+            self.close_client_executor()
         
         T_term = self.termination_round 
         C_total = self.total_rewards_paid
@@ -606,7 +754,7 @@ class Simulation:
         num_honest_clients_at_start = max(1, self.num_honest_clients) 
         num_honest_eliminated = 0
         if self.participants: 
-            num_honest_eliminated = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation < self.reputation_threshold)
+            num_honest_eliminated = int((self.registry.is_honest & ~self.registry.active_mask(self.reputation_threshold)).sum())
         
         FPR = num_honest_eliminated / num_honest_clients_at_start if num_honest_clients_at_start > 0 else 0.0
         if self.num_honest_clients == 0: 
@@ -0,0 +1,138 @@
+import os
+import queue
+import time
+import traceback
+import torch
+import torch.multiprocessing as mp
+from system import Global_Model
+
+
+# 在工作进程中执行单个参与者的一轮本地计算（与串行模式的逻辑一致）
+def run_participant_round(p, global_state, current_round, gt_flat_history, num_total_clients):
+    p.set_model_state(global_state)
+    if p.type == "honest_client":
+        p.perf_before_local_train, _ = p.evaluate_model(on_val_set=True)
+        p.local_train()
+        p.gen_true_update(global_state)
+    else:
+        p.gen_fabric_update(current_round, gt_flat_history, global_state, num_total_clients)
+
+
+def _worker_loop(task_queue, result_queue):
+    # 张量通过队列（而非进程参数）传递，才能走 torch 的共享内存通道
+    shard, global_flat, num_threads = task_queue.get()
+    torch.set_num_threads(num_threads)
+    template = Global_Model().state_dict()
+    # 全局参数以共享内存广播，这里只构造只读视图
+    global_state, offset = {}, 0
+    for key, value in template.items():
+        global_state[key] = global_flat[offset: offset + value.numel()].view_as(value)
+        offset += value.numel()
+
+    while True:
+        task = task_queue.get()
+        if task is None: break
+        current_round, gt_flat_history, num_total_clients, participant_ids, released_ids = task
+        # 任何异常都回传给主进程 (而不是让工作进程静默退出，主进程永远等不到结果)
+        try:
+            results = []
+            for p in shard:
+                # 主进程中已被淘汰并释放资源的参与者：工作进程中的副本同样释放，之后直接跳过
+                if p.id in released_ids:
+                    if not p.released: p.release_resources()
+                    continue
+                # 未被选中的参与者不做本地计算；搭便车者仍需观察全局更新历史以保持估计连续
+                if participant_ids is not None and p.id not in participant_ids:
+                    if p.type == "free_rider": p.update_attack_state(current_round, gt_flat_history)
+                    continue
+                run_participant_round(p, global_state, current_round, gt_flat_history, num_total_clients)
+                update = p.current_update
+                update_flat = p._flatten_params(update).detach().cpu() if update else None
+                p.current_update = None
+                round_state = {field: getattr(p, field) for field in p.round_state_fields}
+                results.append((p.id, update_flat, round_state))
+        except Exception:
+            result_queue.put(("error", traceback.format_exc()))
+            continue
+        result_queue.put(("ok", results))
+
+
+# 将参与者分片到多个常驻工作进程中执行 run_one_round 的本地计算
+class ParallelRoundExecutor:
+    def __init__(self, participants, num_workers, threads_per_worker=None):
+        self.participants = participants
+        self.num_workers = max(1, min(num_workers, len(participants)))
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.num_workers)
+        self.template_state = Global_Model().state_dict()
+        numel = sum(v.numel() for v in self.template_state.values())
+        self.global_flat = torch.zeros(numel).share_memory_()
+
+        ctx = mp.get_context("spawn")
+        self.result_queue = ctx.Queue()
+        self.task_queues, self.workers = [], []
+        for w in range(self.num_workers):
+            shard = participants[w::self.num_workers]
+            task_queue = ctx.Queue()
+            worker = ctx.Process(target=_worker_loop, args=(task_queue, self.result_queue), daemon=True)
+            worker.start()
+            task_queue.put((shard, self.global_flat, self.threads_per_worker))
+            self.task_queues.append(task_queue)
+            self.workers.append(worker)
+
+
+    # 执行一轮：广播全局参数，收集各参与者展平的更新并写回主进程中的参与者对象
+    # participant_ids 不为 None 时只有这些参与者执行本地计算 (先投标后训练的协议)
+    def run_round(self, global_state, current_round, gt_flat_history, num_total_clients, participant_ids=None):
+        offset = 0
+        for value in global_state.values():
+            self.global_flat[offset: offset + value.numel()].copy_(value.detach().view(-1))
+            offset += value.numel()
+        # 搭便车者只读取最近两次全局更新及其范数，只传这部分的紧凑副本
+        history = gt_flat_history.latest(2)
+        released_ids = {p.id for p in self.participants if p.released}
+        for task_queue in self.task_queues:
+            task_queue.put((current_round, history, num_total_clients,
+                            set(participant_ids) if participant_ids is not None else None, released_ids))
+
+        results = {}
+        for _ in self.workers:
+            status, payload = self._get_result()
+            if status == "error": raise RuntimeError(f"参与者工作进程执行失败:\n{payload}")
+            for participant_id, update_flat, round_state in payload:
+                results[participant_id] = (update_flat, round_state)
+
+        for p in self.participants:
+            if p.id not in results: continue
+            update_flat, round_state = results[p.id]
+            for field, value in round_state.items(): setattr(p, field, value)
+            p.current_update = None
+            if update_flat is not None:
+                p.current_update = p._unflatten_params(update_flat.to(p.device), self.template_state)
+
+
+    # 等待一个工作进程的结果；定期检查工作进程是否存活，已崩溃 (未回传结果就退出) 时抛出异常而不是一直阻塞
+    def _get_result(self, poll_interval=5.0):
+        while True:
+            try:
+                return self.result_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                dead = [w.pid for w in self.workers if not w.is_alive()]
+                if dead: raise RuntimeError(f"参与者工作进程意外退出 (pid {dead})")
+
+
+    # 通知工作进程退出；等待期间清空结果队列 (出错中断的轮次可能留有未读结果，阻塞工作进程退出)，
+    # 10 秒后仍未退出的工作进程直接终止
+    def close(self, timeout=10.0):
+        for task_queue in self.task_queues: task_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            while worker.is_alive() and time.monotonic() < deadline:
+                try:
+                    while True: self.result_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                worker.join(timeout=0.1)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self.task_queues, self.workers = [], []
@@ -2,7 +2,6 @@ import torch
 import random
 import numpy as np
 import copy
-from torch.utils.data import DataLoader
 import json
 import time
 import traceback
@@ -18,9 +17,14 @@ from pymoo.optimize import minimize
 from pymoo.termination import get_termination
 
 # --- 自定义模拟组件导入 ---
-from system import get_mnist_data, Global_Model, Requester
+from system import get_mnist_data, Global_Model, Requester, ParticipantRegistry
+from data_cache import MNIST_DATA_ROOT
 from honest_client import HonestClient
 from free_rider import FreeRider
+from batched_training import train_clients_batched
+from parallel_clients import ParallelRoundExecutor
+from client_evaluation import ClientDataEvaluator
+from testset_evaluation import HeldOutEvaluator
 
 
 # 用于存储所有评估的详细结果，包括声誉历史
@@ -48,6 +52,8 @@ class Simulation:
         self.initial_M_t = params_X.get("initial_M_t")
         self.iid_data_distribution = params_X.get("iid_data")
         self.non_iid_alpha = params_X.get("non_iid_alpha")
+        self.data_root = params_X.get("data_root", MNIST_DATA_ROOT)
+        self.partition_seed = params_X.get("partition_seed")
 
         self.alpha_reward = params_X.get("alpha_reward")
         self.beta_penalty_base = params_X.get("beta_penalty_base")
@@ -70,8 +76,26 @@ class Simulation:
         self.local_epochs_honest = params_X.get("local_epochs_honest")
         self.lr_honest = params_X.get("lr_honest")
         self.batch_size_honest = params_X.get("batch_size_honest")
+        self.batched_local_train = params_X.get("batched_local_train", False)
+        self.batched_client_chunk_size = params_X.get("batched_client_chunk_size")
+        self.num_client_workers = params_X.get("num_client_workers", 0)
+        self.threads_per_client_worker = params_X.get("threads_per_client_worker")
+        self.verification_mode = params_X.get("verification_mode", "serial")
+        self.verification_chunk_size = params_X.get("verification_chunk_size")
+        self.verification_failure_prob = params_X.get("verification_failure_prob", 0.05)
+        self.test_batch_size = params_X.get("test_batch_size", 2048) # Requester 评估测试集时的批大小
+        self.verification_batch_size = params_X.get("verification_batch_size", 128) # 序贯验证每次检查前的样本数
+        self.screening_loss_threshold = params_X.get("screening_loss_threshold", None) # 一阶筛查阈值: 预测测试损失增量超过该值的更新不做完整验证 (None 表示关闭)
+        self.verification_coreset_size = params_X.get("verification_coreset_size", None) # 紧凑验证集 (核心集) 样本数，逐个/分组验证在其上进行 (None 表示使用完整测试集)
+        self.coreset_build_version = params_X.get("coreset_build_version", 1) # 全局模型聚合达到该次数后构建核心集
+        self.group_attribution_margin = params_X.get("group_attribution_margin", None) # 分组检验: None 时通过组的成员逐个复验；给定时份额超出 promise 该值的成员按一阶归属判定 (不加声誉)
+        self.batched_client_evaluation = params_X.get("batched_client_evaluation", True) # 本轮开始时是否把所有诚实客户端对全局模型的评估合并为一次前向
+        self.client_evaluation_batch_size = params_X.get("client_evaluation_batch_size", 4096) # 合并评估时的批大小
+        self.client_evaluator = None
+        self.client_executor = None
 
         self.participants = []
+        self.registry = None # 参与者的结构数组注册表 (声誉/投标/选中状态等)
         self.requester = None
         self.current_round = 0
         self.M_t = self.initial_M_t
@@ -101,24 +125,33 @@ class Simulation:
 
     def initialize_environment(self):
         self.log_message("--- initialize_environment START ---")
+        # 工作进程内的参与者逐个执行 local_train，批量同步训练只在主进程串行模式下可用
+        if self.batched_local_train and self.num_client_workers > 0:
+            raise ValueError("batched_local_train 不能与 num_client_workers > 0 同时使用 (工作进程逐个训练客户端)")
         initial_global_model = Global_Model()
         client_datasets, test_dataset_global = get_mnist_data(
-            self.num_honest_clients, self.iid_data_distribution, self.non_iid_alpha
+            self.num_honest_clients, self.iid_data_distribution, self.non_iid_alpha, self.data_root,
+            partition_seed=self.partition_seed
         )
         if self.num_honest_clients > 0 and (not client_datasets or self.num_honest_clients > len(client_datasets)):
             self.log_message(f"警告: 请求 {self.num_honest_clients} 个诚实客户端数据，实际分配 {len(client_datasets)} 个。")
             if not client_datasets and self.num_honest_clients > 0:
                  raise ValueError(f"诚实客户端数据分配失败: 请求 {self.num_honest_clients}, 得到 {len(client_datasets)}")
 
-        pin_memory_flag = self.device.type != "cpu"
-        # 注意：之前讨论过 num_workers 的问题，这里保持 os.cpu_count()*2，但建议在实际运行中根据系统情况调整为0或小值
-        num_workers_val = os.cpu_count() 
-        test_loader = DataLoader(test_dataset_global, batch_size=128, shuffle=False,
-                                 pin_memory=pin_memory_flag, num_workers=num_workers_val)
+        # 测试集一次性预加载到设备上，评估以大批次进行，不再为每次评估启动 DataLoader 工作进程
+        test_loader = HeldOutEvaluator.from_dataset(test_dataset_global, self.device, self.test_batch_size)
 
         self.requester = Requester(initial_global_model, test_loader, self.device,
                              alpha_reward=self.alpha_reward,
-                             beta_penalty_base=self.beta_penalty_base)
+                             beta_penalty_base=self.beta_penalty_base,
+                             verification_mode=self.verification_mode,
+                             verification_chunk_size=self.verification_chunk_size,
+                             verification_failure_prob=self.verification_failure_prob,
+                             verification_batch_size=self.verification_batch_size,
+                             screening_loss_threshold=self.screening_loss_threshold,
+                             verification_coreset_size=self.verification_coreset_size,
+                             coreset_build_version=self.coreset_build_version,
+                             group_attribution_margin=self.group_attribution_margin)
         self.participants = []
         temp_participants = []
         for i in range(self.num_honest_clients):
@@ -152,6 +185,11 @@ class Simulation:
 
         random.shuffle(temp_participants)
         self.participants = temp_participants
+        if self.batched_client_evaluation:
+            self.client_evaluator = ClientDataEvaluator(self.client_evaluation_batch_size, self.device)
+        if self.num_client_workers > 0 and self.participants:
+            self.client_executor = ParallelRoundExecutor(self.participants, self.num_client_workers, self.threads_per_client_worker)
+        self.registry = ParticipantRegistry(self.participants)
         self.client_reputation_history = {}
         for p in self.participants:
             self.client_types[p.id] = p.type
@@ -171,12 +209,12 @@ class Simulation:
         if self.requester:
             self.final_global_model_performance, _ = self.requester.evaluate_global_model()
             if self.requester.global_model:
-                 self.requester.previous_global_model_state_flat = self.requester._flatten_params(self.requester.global_model.state_dict())
+                 self.requester.previous_global_model_state_flat = self.requester.global_model.flat_params.detach().clone()
             self.log_message(f"初始全局模型性能: {self.final_global_model_performance:.4f}")
             self.simulation_stats["round_number"].append(0)
             self.simulation_stats["model_accuracy"].append(self.final_global_model_performance)
-            initial_active_honest = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation >= self.reputation_threshold)
-            initial_active_free_riders = sum(1 for p in self.participants if self.client_types.get(p.id) == "free_rider" and p.reputation >= self.reputation_threshold)
+            initial_active_honest = int((self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
+            initial_active_free_riders = int((~self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
             self.simulation_stats["active_honest_clients"].append(initial_active_honest)
             self.simulation_stats["active_free_riders"].append(initial_active_free_riders)
             self.simulation_stats["M_t_value"].append(self.M_t)
@@ -193,34 +231,30 @@ class Simulation:
     def update_M_t(self):
         if self.current_round == 0 or not self.participants:
             return
-        active_participants = [p for p in self.participants if p.reputation >= self.reputation_threshold]
-        if not active_participants:
-            self.M_t = 0 if not self.participants else 1
+
+        active_mask = self.registry.active_mask(self.reputation_threshold)
+        num_active = int(active_mask.sum())
+        if num_active == 0:
+            self.M_t = 1
             return
-        delta_reputations_list = [p.get_delta_reputation() for p in active_participants if hasattr(p, 'get_delta_reputation')]
-        if not delta_reputations_list: return
-        sorted_delta_r = sorted(delta_reputations_list, reverse=True)
+
+        # 活跃参与者的声誉变化量降序排列；在 j > 1 的相邻间隔中取最大者 (并列取最靠前的)，k' = j + 1
+        sorted_delta_r = -np.sort(-self.registry.delta_reputation()[active_mask])
         k_prime_t_candidate = 1
-        if len(sorted_delta_r) > 1:
-            max_gap, current_max_gap_idx = -1.0, 0
-            for j in range(len(sorted_delta_r) - 1):
-                gap = sorted_delta_r[j] - sorted_delta_r[j+1]
-                if gap > max_gap and j > 1:
-                    max_gap = gap
-                    current_max_gap_idx = j
-            k_prime_t_candidate = current_max_gap_idx + 1
-        elif len(sorted_delta_r) == 1: k_prime_t_candidate = 1
-        else: return
-        num_positive_delta_reps = sum(1 for dr in sorted_delta_r if dr > 1e-4)
+        if len(sorted_delta_r) > 3:
+            gaps = sorted_delta_r[2:-1] - sorted_delta_r[3:]
+            k_prime_t_candidate = 2 + int(np.argmax(gaps)) + 1
+
+        num_positive_delta_reps = int((sorted_delta_r > 1e-4).sum())
         final_k_prime_t = k_prime_t_candidate
         if k_prime_t_candidate <= 1 and num_positive_delta_reps > 1:
             final_k_prime_t = max(k_prime_t_candidate, min(num_positive_delta_reps, 3))
-        final_k_prime_t = min(final_k_prime_t, len(active_participants))
-        final_k_prime_t = max(1, final_k_prime_t)
+        final_k_prime_t = max(1, min(final_k_prime_t, num_active))
+
         new_M_t_float = self.omega_m_update * self.M_t + (1 - self.omega_m_update) * final_k_prime_t
         self.M_t = max(1, int(np.round(new_M_t_float)))
-        if active_participants: self.M_t = min(self.M_t, len(active_participants))
-        self.M_t = min(self.M_t, len(self.participants))
+        self.M_t = min(self.M_t, num_active, len(self.participants))
+
 
     # # 修改为实例方法
     # def train_participant(self, participant, global_model_state, current_round=None, model_diff_history=None, participant_count=None):
@@ -259,23 +293,45 @@ class Simulation:
         #     if update:
         #         client_updates_for_submission[p.id] = copy.deepcopy(update)
 
-        for p in self.participants:
-            p.set_model_state(copy.deepcopy(self.requester.global_model.state_dict())) 
-            
-            if p.type == "honest_client":
-                p.perf_before_local_train, _ = p.evaluate_model(on_val_set=True)
-                p.local_train()
-                p.gen_true_update(self.requester.global_model.state_dict()) 
-            else: 
-                p.gen_fabric_update(
-                    self.current_round,
-                    self.requester.global_model_param_diff_history,
-                    self.requester.global_model.state_dict(), 
-                    len(self.participants)
-                )
+        round_start_global_state = self.requester.global_model.state_dict() # 只读共享视图，聚合前不会被修改
+        honest_clients_to_train = []
+        # 已淘汰的参与者不再评估、训练或生成更新
+        active = [p for p in self.participants if p.reputation >= self.reputation_threshold]
+        if self.client_executor is not None:
+            participant_ids = None if len(active) == len(self.participants) else [p.id for p in active]
+            self.client_executor.run_round(round_start_global_state, self.current_round,
+                                           self.requester.global_model_param_diff_history, len(self.participants),
+                                           participant_ids)
+        else:
+            honest_active = [p for p in active if p.type == "honest_client"]
+            if self.client_evaluator is not None and honest_active:
+                self.client_evaluator.evaluate(self.requester.global_model, honest_active)
+            for p in active:
+                p.set_model_state(round_start_global_state)
+
+                if p.type == "honest_client":
+                    if self.client_evaluator is None: p.perf_before_local_train, _ = p.evaluate_model(on_val_set=True)
+                    if self.batched_local_train:
+                        honest_clients_to_train.append(p)
+                        continue
+                    p.local_train()
+                    p.gen_true_update(round_start_global_state)
+                else:
+                    p.gen_fabric_update(
+                        self.current_round,
+                        self.requester.global_model_param_diff_history,
+                        round_start_global_state,
+                        len(self.participants)
+                    )
+
+        if honest_clients_to_train:
+            train_clients_batched(honest_clients_to_train, self.batched_client_chunk_size)
+            for p in honest_clients_to_train:
+                p.gen_true_update(round_start_global_state)
 
-            if p.current_update: 
-                client_updates_for_submission[p.id] = copy.deepcopy(p.current_update)
+        for p in self.participants:
+            if p.current_update:
+                client_updates_for_submission[p.id], p.current_update = p.current_update, None
 
         honest_bids_promises, honest_bids_rewards, honest_bids_ratios = [], [], []
         num_bidding_honest_clients = 0
@@ -304,7 +360,7 @@ class Simulation:
                 if p_fr_bid_default.reputation >= self.reputation_threshold and p_fr_bid_default.type == "free_rider":
                     p_fr_bid_default.submit_bid(0,0,0,0)
 
-        selected_participants = self.requester.select_participants(self.participants, m_t_for_this_round, self.reputation_threshold)
+        selected_participants = self.requester.select_participants(self.registry, m_t_for_this_round, self.reputation_threshold)
 
         current_round_rewards_to_freeriders_this_round = 0 # 初始化本轮给FR的奖励
 
@@ -325,13 +381,13 @@ class Simulation:
                     updates_to_verify, round_start_global_accuracy
                 )
                 rewards_paid_ref = [self.total_rewards_paid]
-                self.requester.update_reputations_and_pay(self.participants, verification_outcomes, rewards_paid_ref)
+                self.requester.update_reputations_and_pay(self.registry, verification_outcomes, rewards_paid_ref)
                 self.total_rewards_paid = rewards_paid_ref[0]
 
                 current_round_rewards_to_honest_clients_this_round = 0
                 for outcome in verification_outcomes: # 修正TIR计算的逻辑错误
                     if outcome["successful_verification"]:
-                        p_find = next((p for p in self.participants if p.id == outcome["participant_id"]), None)
+                        p_find = self.registry.get(outcome["participant_id"])
                         if p_find:
                             if self.client_types.get(p_find.id) == "honest_client":
                                 current_round_rewards_to_honest_clients_this_round += p_find.bid.get('reward', 0)
@@ -342,14 +398,18 @@ class Simulation:
 
                 if self.verbose:
                     for outcome in verification_outcomes:
-                        par = next((p_find_log for p_find_log in self.participants if p_find_log.id == outcome["participant_id"]), None)
+                        par = self.registry.get(outcome["participant_id"])
                         if par:
-                            status_str = "成功" if outcome["successful_verification"] else "失败"
+                            status_str = ("成功 (一阶归属)" if outcome.get("attributed_increase") else "成功") if outcome["successful_verification"] else ("一阶筛除" if outcome.get("screened_out") else "失败")
+                            error_str = f" (±{outcome['accuracy_error']:.3f})" if "accuracy_error" in outcome else "" # 核心集验证的准确率误差或序贯验证的置信半径
                             self.log_message(f"  - {par.id} ({self.client_types[par.id]}), 声誉: {par.reputation:.2f}, "
                                   f"投标: P={par.bid.get('promise',0):.3f}/R={par.bid.get('reward',0):.2f}, "
-                                  f"观察提升: {outcome.get('observed_increase',0):.3f}, 状态: {status_str}")
+                                  f"观察提升: {outcome.get('observed_increase',0):.3f}{error_str}, 状态: {status_str}")
 
-        for p_every in self.participants: p_every.update_reputation_history()
+        self.registry.push_reputation_history(np.arange(len(self.registry))) # 所有参与者的声誉窗口一次性前移
+        # 声誉跌破阈值的参与者不会再被选中，释放其本地资源
+        for slot in np.flatnonzero(~self.registry.active_mask(self.reputation_threshold)):
+            if not self.registry.participants[slot].released: self.registry.participants[slot].release_resources()
         for p_track in self.participants:
             if p_track.id in self.client_reputation_history:
                  self.client_reputation_history[p_track.id].append(p_track.reputation)
@@ -360,8 +420,8 @@ class Simulation:
         self.final_global_model_performance, _ = self.requester.evaluate_global_model()
         self.update_M_t()
 
-        num_active_honest = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation >= self.reputation_threshold)
-        num_active_free_riders = sum(1 for p in self.participants if self.client_types.get(p.id) == "free_rider" and p.reputation >= self.reputation_threshold)
+        num_active_honest = int((self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
+        num_active_free_riders = int((~self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
 
         if self.num_free_riders > 0 and not self.all_fr_elimination_achieved_flag and num_active_free_riders == 0:
             self.total_rewards_obtained_by_fr_at_elimination = self.total_rewards_obtained_by_fr # 更新FR获得奖励的记录点
@@ -401,13 +461,13 @@ class Simulation:
             self.termination_round = self.max_rounds
             return True
         if self.num_honest_clients > 0 and self.current_round > 0:
-            num_active_honest_val = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation >= self.reputation_threshold)
+            num_active_honest_val = int((self.registry.is_honest & self.registry.active_mask(self.reputation_threshold)).sum())
             if num_active_honest_val == 0:
                 self.log_message("没有活跃的诚实客户端了。终止模拟。")
                 self.termination_round = self.current_round
                 return True
         if self.current_round > 0:
-            num_active_total_final_check_val = sum(1 for p in self.participants if p.reputation >= self.reputation_threshold)
+            num_active_total_final_check_val = int(self.registry.active_mask(self.reputation_threshold).sum())
             if num_active_total_final_check_val == 0:
                 self.log_message("没有活跃的参与者了。终止模拟。")
                 self.termination_round = self.current_round
@@ -434,7 +494,7 @@ class Simulation:
 
         final_fpr = 0.0
         if self.num_honest_clients > 0 and self.participants:
-            num_honest_eliminated = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation < self.reputation_threshold)
+            num_honest_eliminated = int((self.registry.is_honest & ~self.registry.active_mask(self.reputation_threshold)).sum())
             final_fpr = num_honest_eliminated / self.num_honest_clients
         elif self.num_honest_clients == 0 : final_fpr = 0.0
         final_tir = (self.rewards_paid_to_honest_clients / self.total_rewards_paid) if self.total_rewards_paid > 1e-9 else 0.0
@@ -481,6 +541,11 @@ class Simulation:
         except Exception as e:
             self.log_message(f"保存统计数据到文件 {filename} 时发生错误: {type(e).__name__} - {e}")
 
+    def close_client_executor(self):
+        if self.client_executor is not None:
+            self.client_executor.close()
+            self.client_executor = None
+
     def run_simulation(self):
         self.log_message(f"--- SIM: run_simulation CALLED (verbose={self.verbose}) ---")
         original_verbose_state = self.verbose
@@ -513,26 +578,29 @@ class Simulation:
              return [float('inf'), 1.0], [1.0e9, 1.0], {"PFM_final": 0.0, "error": "Requester/Participants not initialized", "client_reputation_history": self.client_reputation_history}
 
         self.log_message("--- SIM: run_simulation --- Proceeding to main simulation loop. ---")
-        terminated = False
-        while not terminated:
-            terminated = self.run_one_round()
-            if not terminated and \
-               self.min_performance_constraint > 0 and \
-               self.final_global_model_performance < self.min_performance_constraint * 0.25 and \
-               self.current_round > min(10, self.max_rounds / 3) and \
-               self.max_rounds > 10 :
-                self.log_message(f"全局模型性能 ({self.final_global_model_performance:.4f}) 过低 (远低于约束 {self.min_performance_constraint*0.25:.4f})，提前终止。")
-                if self.termination_round == self.max_rounds:
-                    self.termination_round = self.current_round
-                terminated = True
-            if terminated: break
+        try:
+            terminated = False
+            while not terminated:
+                terminated = self.run_one_round()
+                if not terminated and \
+                   self.min_performance_constraint > 0 and \
+                   self.final_global_model_performance < self.min_performance_constraint * 0.25 and \
+                   self.current_round > min(10, self.max_rounds / 3) and \
+                   self.max_rounds > 10 :
+                    self.log_message(f"全局模型性能 ({self.final_global_model_performance:.4f}) 过低 (远低于约束 {self.min_performance_constraint*0.25:.4f})，提前终止。")
+                    if self.termination_round == self.max_rounds:
+                        self.termination_round = self.current_round
+                    terminated = True
+                if terminated: break
+        finally:
+            self.close_client_executor()
 
         T_term = self.termination_round
         C_total_final = self.total_rewards_paid
         num_honest_clients_at_start = max(1, self.num_honest_clients)
         num_honest_eliminated = 0
         if self.participants:
-            num_honest_eliminated = sum(1 for p in self.participants if self.client_types.get(p.id) == "honest_client" and p.reputation < self.reputation_threshold)
+            num_honest_eliminated = int((self.registry.is_honest & ~self.registry.active_mask(self.reputation_threshold)).sum())
         FPR_final = num_honest_eliminated / num_honest_clients_at_start if num_honest_clients_at_start > 0 else 0.0
         if self.num_honest_clients == 0: FPR_final = 0.0
         PFM_final = self.final_global_model_performance
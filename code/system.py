@@ -1,16 +1,22 @@
 import torch.nn as nn
 import torch
 import copy
+from collections import OrderedDict
 import random
+import os
 import numpy as np
-from torchvision import datasets, transforms
-from torch.utils.data import Subset
-
-
-def get_mnist_data(num_clients, iid, non_iid_alpha):
-    transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))])
-    train_dataset = datasets.MNIST('/data/ddh/data', train=True, download=True, transform=transform)
-    test_dataset = datasets.MNIST('/data/ddh/data', train=False, download=True, transform=transform)
+from data_cache import MNIST_DATA_ROOT, mnist_tensor_dataset, dirichlet_partition
+from verification import stack_candidate_params, evaluate_stacked_accuracies, sequential_verify
+from aggregation import weighted_update_sum
+from update_history import UpdateHistoryBuffer
+from testset_evaluation import HeldOutEvaluator
+from coreset import build_verification_coreset
+
+
+def get_mnist_data(num_clients, iid, non_iid_alpha, data_root=MNIST_DATA_ROOT, partition_seed=None, min_size_per_client=10):
+    # 训练集/测试集只在首次调用时解码并归一化，之后所有模拟共享同一份张量
+    train_dataset = mnist_tensor_dataset(data_root, train=True)
+    test_dataset = mnist_tensor_dataset(data_root, train=False)
     client_datasets = []
     if iid or num_clients == 0:
         if num_clients == 0: return [], test_dataset
@@ -21,32 +27,14 @@ def get_mnist_data(num_clients, iid, non_iid_alpha):
         for i in range(num_clients):
             start_idx, end_idx = i * split_size, (i + 1) * split_size if i < num_clients - 1 else total_size
             if not indices[start_idx:end_idx]: continue
-            client_datasets.append(Subset(train_dataset, indices[start_idx:end_idx]))
+            client_datasets.append(train_dataset.subset(indices[start_idx:end_idx]))
     # Non-IID
     else:   
-        labels = np.array(train_dataset.targets)
-        num_classes = 10
-        min_size_per_client = 10 
-        client_indices_map = {i: [] for i in range(num_clients)}
-        for c in range(num_classes):
-            indices_c = np.where(labels == c)[0]
-            np.random.shuffle(indices_c)
-            proportions = np.random.dirichlet([non_iid_alpha] * num_clients)
-            target_samples_for_class_c = (proportions * len(indices_c)).astype(int)
-            delta = len(indices_c) - np.sum(target_samples_for_class_c)
-            if delta != 0:
-                for _ in range(abs(delta)): target_samples_for_class_c[random.randrange(num_clients)] += np.sign(delta)
-            current_idx = 0
-            for client_id in range(num_clients):
-                num_samples = target_samples_for_class_c[client_id]
-                client_indices_map[client_id].extend(indices_c[current_idx : current_idx + num_samples])
-                current_idx += num_samples
-        for i in range(num_clients):
-            if not client_indices_map[i] or len(client_indices_map[i]) < min_size_per_client // num_classes :
-                rand_indices = random.sample(range(len(train_dataset)), min_size_per_client)
-                client_datasets.append(Subset(train_dataset, rand_indices))
-            else:
-                client_datasets.append(Subset(train_dataset, client_indices_map[i]))
+        partitions = dirichlet_partition(train_dataset.targets.numpy(), num_clients, non_iid_alpha,
+                                         min_size=min_size_per_client, seed=partition_seed,
+                                         cache_dir=os.path.join(data_root, 'partitions'))
+        for client_indices in partitions:
+            client_datasets.append(train_dataset.subset(client_indices))
     return client_datasets, test_dataset
 
 
@@ -62,97 +50,356 @@ class Global_Model(nn.Module):
         self.fc1 = nn.Linear(64 * 7 * 7, 512)
         self.relu3 = nn.ReLU()
         self.fc2 = nn.Linear(512, 10)
+        self._build_flat_arena()
 
 
-    def forward(self, x):
+    # 将全部参数放入一块连续缓冲区 flat_params，各参数均为其视图；展平/还原不再需要拷贝
+    def _build_flat_arena(self):
+        params = list(self.parameters())
+        flat_params = torch.cat([p.detach().reshape(-1) for p in params])
+        offset = 0
+        for p in params:
+            p.data = flat_params[offset: offset + p.numel()].view_as(p)
+            offset += p.numel()
+        self.flat_params = flat_params
+
+
+    # .to()/.cuda()/.double() 等会逐个替换参数张量，之后重新建立连续缓冲区
+    def _apply(self, fn, *args, **kwargs):
+        super(Global_Model, self)._apply(fn, *args, **kwargs)
+        self._build_flat_arena()
+        return self
+
+
+    # deepcopy / pickle 会逐个复制参数，恢复后重新建立连续缓冲区
+    def __setstate__(self, state):
+        super(Global_Model, self).__setstate__(state)
+        self._build_flat_arena()
+
+
+    # 倒数第二层 (fc1 + ReLU) 的特征
+    def features(self, x):
         x = self.pool1(self.relu1(self.conv1(x)))
         x = self.pool2(self.relu2(self.conv2(x)))
         x = x.view(-1, 64 * 7 * 7)
-        x = self.relu3(self.fc1(x))
-        x = self.fc2(x)
-        return x
+        return self.relu3(self.fc1(x))
+
+
+    def forward(self, x):
+        return self.fc2(self.features(x))
 
 
     def deepcopy(self):
         return copy.deepcopy(self)
     
 
+# 展平参数字典：若各张量恰好依次排列在同一块连续缓冲区中 (如 Global_Model.flat_params)，直接返回该缓冲区的一维视图
+def flatten_state(state_dict):
+    tensors = list(state_dict.values())
+    first = tensors[0]
+    expected_offset = first.storage_offset()
+    for t in tensors:
+        if (not t.is_contiguous() or t.dtype != first.dtype or t.storage_offset() != expected_offset
+                or t.untyped_storage().data_ptr() != first.untyped_storage().data_ptr()):
+            return torch.cat([t.reshape(-1) for t in tensors])
+        expected_offset += t.numel()
+    return torch.as_strided(first, (expected_offset - first.storage_offset(),), (1,), first.storage_offset())
+
+
+# 将一维张量按参数字典的形状切分为视图，不复制数据
+def unflatten_state(flat_params, model_state_dict):
+    new_state_dict, current_pos = OrderedDict(), 0
+    for key, param in model_state_dict.items():
+        num_elements = param.numel()
+        new_state_dict[key] = flat_params[current_pos : current_pos + num_elements].view_as(param)
+        current_pos += num_elements
+    return new_state_dict
+
+
+# 投标的字典式视图：读写直接落在注册表的 bid_promise / bid_reward 数组上，NaN 表示该项未投标
+class RegistryBid:
+    _fields = ("promise", "reward")
+
+    def __init__(self, registry, slot):
+        self.registry, self.slot = registry, slot
+
+
+    def _array(self, key):
+        if key == "promise": return self.registry.bid_promise
+        if key == "reward": return self.registry.bid_reward
+        raise KeyError(key)
+
+
+    def __getitem__(self, key):
+        value = self._array(key)[self.slot]
+        if np.isnan(value): raise KeyError(key)
+        return float(value)
+
+
+    def __setitem__(self, key, value):
+        self._array(key)[self.slot] = value
+
+
+    def __contains__(self, key):
+        return key in self._fields and not np.isnan(self._array(key)[self.slot])
+
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+    def keys(self):
+        return [key for key in self._fields if key in self]
+
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def clear(self):
+        self.registry.bid_promise[self.slot] = self.registry.bid_reward[self.slot] = np.nan
+
+
+# 挂到 ParticipantRegistry 之前存放在实例上，之后读写注册表中对应槽位的数组元素
+def _registry_field(name):
+    def getter(self):
+        if self.registry is None: return self.__dict__["_" + name]
+        return getattr(self.registry, name)[self.slot].item()
+    def setter(self, value):
+        if self.registry is None: self.__dict__["_" + name] = value
+        else: getattr(self.registry, name)[self.slot] = value
+    return property(getter, setter)
+
+
 class Participant:
+    reputation = _registry_field("reputation")
+    fail_num = _registry_field("fail_num")
+    selected = _registry_field("selected")
+
     def __init__(self, id, type, ini_rep, tra_round_num, device):
+        self.registry, self.slot = None, None
         self.id = id
         self.type = type
         self.reputation = ini_rep
         self.selected = False
         self.fail_num = 0
-        self.reputation_history = [ini_rep] * tra_round_num
+        # 定长环形窗口：reputation_history_pos 指向最旧的一项 (即下一次写入的位置)
+        self.reputation_history = np.full(tra_round_num, ini_rep, dtype=np.float64)
+        self.reputation_history_pos = 0
         self.bid = {}
         self.device = device
         self.tra_round_num = tra_round_num
         self.model = None
+        self.current_update = None # 本轮生成的更新 (未执行本地计算的轮次保持为 None)
+        self.released = False # 被淘汰后已释放本地资源
+
+
+    @property
+    def bid(self):
+        return self._bid if self.registry is None else RegistryBid(self.registry, self.slot)
+
+
+    @bid.setter
+    def bid(self, value):
+        if self.registry is None:
+            self._bid = value
+            return
+        bid = RegistryBid(self.registry, self.slot)
+        bid.clear()
+        for key, item in value.items(): bid[key] = item
 
 
+    # 跨进程传递时脱离注册表，带上各字段的当前值
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.registry is not None:
+            state.update(_reputation=self.reputation, _fail_num=self.fail_num, _selected=self.selected,
+                         _bid=dict(self.bid.items()), reputation_history=self.registry.reputation_window[self.slot].copy(),
+                         reputation_history_pos=int(self.registry.window_pos[self.slot]))
+            state["registry"], state["slot"] = None, None
+        return state
+
+
+    # 覆盖最旧的一项并前移指针，O(1)
     def update_reputation_history(self):
-        if len(self.reputation_history) >= self.tra_round_num: self.reputation_history.pop(0)
-        self.reputation_history.append(self.reputation)
+        if self.registry is not None: return self.registry.push_reputation_history([self.slot])
+        if self.tra_round_num == 0: return
+        self.reputation_history[self.reputation_history_pos] = self.reputation
+        self.reputation_history_pos = (self.reputation_history_pos + 1) % self.tra_round_num
 
 
+    # |当前声誉 - 窗口中最旧的声誉|，O(1)
     def get_delta_reputation(self):
-        if not self.reputation_history: return 0.0
-        return abs(self.reputation - self.reputation_history[0])
+        if self.registry is not None: return float(self.registry.reputation_delta_of(self.slot))
+        if self.tra_round_num == 0: return 0.0
+        return abs(self.reputation - self.reputation_history[self.reputation_history_pos])
+
 
+    # 被淘汰 (声誉低于阈值) 后释放本地模型和未提交的更新，此后不再执行任何本地计算
+    def release_resources(self):
+        self.model, self.current_update, self.released = None, None, True
 
+
+    # 本地模型在整个生命周期内常驻 (首次调用时构造)，全局参数以一次 copy_ 原地写入其连续缓冲区；
+    # state_dict 可以是共享的只读全局视图，此时展平同样不复制
     def set_model_state(self, state_dict):
         if self.model is None: self.model = Global_Model().to(self.device)
-        try: self.model.load_state_dict(state_dict)
-        except RuntimeError as e:
-            print(f"错误：参与者 {self.id} 加载模型状态失败: {e}")
-            self.model = Global_Model().to(self.device)
-            self.model.load_state_dict(state_dict)
+        flat_state = flatten_state(state_dict)
+        if flat_state.numel() != self.model.flat_params.numel():
+            raise RuntimeError(f"参与者 {self.id} 收到的模型状态参数量 ({flat_state.numel()}) "
+                               f"与本地模型 ({self.model.flat_params.numel()}) 不一致")
+        with torch.no_grad(): self.model.flat_params.copy_(flat_state)
 
 
-    # 展平参数为一维张量
+    # 展平参数为一维张量 (连续缓冲区时为零拷贝视图)
     def _flatten_params(self, model_state_dict):
-        return torch.cat([p.view(-1) for p in model_state_dict.values()])
+        return flatten_state(model_state_dict)
 
 
-    # 将一维张量还原为模型参数字典
+    # 将一维张量还原为模型参数字典 (各项为 flat_params 的视图)
     def _unflatten_params(self, flat_params, model_state_dict):
-        new_state_dict = copy.deepcopy(model_state_dict)
-        current_pos = 0
-        for key in new_state_dict:
-            param = new_state_dict[key]
-            num_elements = param.numel()
-            new_state_dict[key] = flat_params[current_pos : current_pos + num_elements].view_as(param)
-            current_pos += num_elements
-        return new_state_dict
+        return unflatten_state(flat_params, model_state_dict)
+
+
+# 结构数组形式的参与者注册表：声誉、失败次数、选中状态、投标、类型及声誉窗口按槽位存放在 NumPy 数组中，
+# 选择/奖惩/M_t 更新在数组上向量化完成。参与者对象挂到注册表后，对应属性直接读写这些数组。
+# 声誉窗口 [N, W] 按行环形存放 (window_pos 指向每行最旧的一项)，与原先 pop(0) + append 的列表语义相同。
+class ParticipantRegistry:
+    def __init__(self, participants):
+        self.participants = list(participants)
+        num = len(self.participants)
+        self.ids = [p.id for p in self.participants]
+        self.slot_of = {p.id: i for i, p in enumerate(self.participants)}
+        self.is_honest = np.array([p.type == "honest_client" for p in self.participants], dtype=bool)
+        self.reputation = np.array([p.reputation for p in self.participants], dtype=np.float64)
+        self.fail_num = np.array([p.fail_num for p in self.participants], dtype=np.int64)
+        self.selected = np.array([p.selected for p in self.participants], dtype=bool)
+        self.bid_promise = np.array([p.bid.get('promise', np.nan) for p in self.participants], dtype=np.float64)
+        self.bid_reward = np.array([p.bid.get('reward', np.nan) for p in self.participants], dtype=np.float64)
+        self.window_size = self.participants[0].tra_round_num if self.participants else 0
+        self.reputation_window = np.array([p.reputation_history for p in self.participants],
+                                          dtype=np.float64).reshape(num, self.window_size)
+        self.window_pos = np.array([p.reputation_history_pos for p in self.participants], dtype=np.int64)
+        for i, p in enumerate(self.participants): p.registry, p.slot = self, i
+
+
+    def __len__(self):
+        return len(self.participants)
+
+
+    def __iter__(self):
+        return iter(self.participants)
+
+
+    def get(self, participant_id):
+        slot = self.slot_of.get(participant_id)
+        return None if slot is None else self.participants[slot]
+
+
+    def active_mask(self, reputation_threshold):
+        return self.reputation >= reputation_threshold
+
+
+    # 向窗口追加当前声誉 (每个槽位一次)，满窗口时覆盖最旧的一项
+    def push_reputation_history(self, slots):
+        if self.window_size == 0: return
+        slots = np.unique(np.asarray(slots, dtype=np.int64))
+        self.reputation_window[slots, self.window_pos[slots]] = self.reputation[slots]
+        self.window_pos[slots] = (self.window_pos[slots] + 1) % self.window_size
+
+
+    # |当前声誉 - 窗口中最旧的声誉|
+    def delta_reputation(self):
+        if self.window_size == 0: return np.zeros(len(self.participants))
+        oldest = self.reputation_window[np.arange(len(self.participants)), self.window_pos]
+        return np.abs(self.reputation - oldest)
+
+
+    def reputation_delta_of(self, slot):
+        if self.window_size == 0: return 0.0
+        return abs(self.reputation[slot] - self.reputation_window[slot, self.window_pos[slot]])
 
 
 class Requester:
     def __init__(self, initial_global_model, test_loader, device,
-                 alpha_reward, beta_penalty_base):
+                 alpha_reward, beta_penalty_base, verification_mode="serial", verification_chunk_size=None,
+                 verification_failure_prob=0.05, global_history_capacity=10, verification_batch_size=None,
+                 screening_loss_threshold=None, verification_coreset_size=None, coreset_build_version=1,
+                 group_attribution_margin=None):
         self.global_model = initial_global_model.to(device)
-        self.test_loader = test_loader
+        # 测试集常驻设备的评估器 (传入普通批迭代器时遍历一次转为常驻张量)
+        self.test_loader = test_loader if isinstance(test_loader, HeldOutEvaluator) else HeldOutEvaluator.from_loader(test_loader, device)
         self.device = device
         self.criterion = nn.CrossEntropyLoss()
         self.previous_global_model_state_flat = None
-        self.global_model_param_diff_history = []
+        # 最近 global_history_capacity 次全局更新的环形缓冲区 (预分配，范数缓存)
+        self.global_model_param_diff_history = UpdateHistoryBuffer(global_history_capacity, device)
         self.alpha_reward = alpha_reward
         self.beta_penalty_base = beta_penalty_base
+        # "serial"：逐个候选构建模型并评估；"stacked"：堆叠所有候选参数，单次遍历测试集；
+        # "sequential"：与基线逐样本配对比较，置信界判定通过/失败后提前停止；
+        # "group"：分组检验，先评估一组候选的平均更新，未通过的组二分递归
+        self.verification_mode = verification_mode
+        self.last_verification_passes = 0 # 上一次验证中测试集完整评估的次数
+        self.verification_chunk_size = verification_chunk_size
+        # 全局模型版本号：每次聚合写回参数时递增；评估结果按版本缓存
+        self.model_version = 0
+        self._global_evaluation_cache = {}
+        # 序贯验证：失败概率上限、按加载顺序保存的测试集张量及当前版本全局模型的逐样本正确性
+        self.verification_failure_prob = verification_failure_prob
+        self.verification_batch_size = verification_batch_size or self.test_loader.batch_size # 序贯验证每次检查前的样本数
+        self.verification_generator = torch.Generator() # 固定种子的独立生成器，不消耗全局随机状态
+        self._test_tensors = None
+        self._global_sample_correct = None
+        self._scratch_model = None
+        # 一阶筛查 (可选)：预测的测试损失变化 g·u 超过阈值的候选直接判定失败，不做完整评估；None 表示关闭
+        # g 为当前版本全局模型的测试损失梯度，按版本缓存，每轮 (每个模型版本) 只计算一次
+        self.screening_loss_threshold = screening_loss_threshold
+        self._loss_gradient, self._loss_gradient_version = None, None
+        # 紧凑验证集 (可选)：全局模型版本达到 coreset_build_version 时由其倒数第二层特征构建一次，
+        # 之后逐个/分组验证在核心集上进行 (基线同样取全局模型在核心集上的准确率)；evaluate_global_model 仍使用完整测试集
+        self.verification_coreset_size = verification_coreset_size
+        self.coreset_build_version = coreset_build_version
+        self.verification_set = None
+        self.coreset_statistical_error = None
+        self.verification_accuracy_error = None # 核心集准确率的估计误差：统计误差与当前全局模型实测偏差中的较大者
+        self._coreset_baseline = (None, None) # (模型版本, 全局模型在核心集上的准确率)
+        # 分组检验中通过组的成员：None 时每个成员都单独复验后才判定通过；给定 margin 时，
+        # 一阶归属份额不低于 promise + margin 的成员不再复验，按归属份额判定 (结果标记 attributed_increase，不增加声誉)
+        self.group_attribution_margin = group_attribution_margin
 
 
     def _flatten_params(self, model_state_dict):
-        return torch.cat([p.view(-1) for p in model_state_dict.values()]).cpu()
+        return flatten_state(model_state_dict)
+
+
+    # 按全局模型参数顺序展平更新，缺失的键按零处理
+    def _flatten_update(self, update, reference_state):
+        if update.keys() == reference_state.keys(): return flatten_state(update)
+        return flatten_state(OrderedDict((key, update[key] if key in update else torch.zeros_like(param))
+                                         for key, param in reference_state.items()))
 
 
     def update_global_model_history(self):
-        current_global_model_state_flat = self._flatten_params(self.global_model.state_dict())
+        current_global_model_state_flat = self.global_model.flat_params.detach()
         if self.previous_global_model_state_flat is not None:
-            g_t_flat = current_global_model_state_flat - self.previous_global_model_state_flat
-            if torch.linalg.norm(g_t_flat) > 1e-6 :
-                self.global_model_param_diff_history.append(g_t_flat)
-                if len(self.global_model_param_diff_history) > 10:
-                    self.global_model_param_diff_history.pop(0)
-        self.previous_global_model_state_flat = current_global_model_state_flat.clone()
+            # 差值直接写入环形缓冲区的下一个槽位，范数足够大时才确认写入
+            g_t_flat = torch.sub(current_global_model_state_flat, self.previous_global_model_state_flat,
+                                 out=self.global_model_param_diff_history.next_slot(current_global_model_state_flat))
+            g_t_norm = torch.linalg.norm(g_t_flat)
+            if g_t_norm > 1e-6 :
+                self.global_model_param_diff_history.commit(g_t_norm)
+            self.previous_global_model_state_flat.copy_(current_global_model_state_flat)
+        else:
+            self.previous_global_model_state_flat = current_global_model_state_flat.clone()
 
 
     # # 原版本
@@ -173,86 +420,241 @@ class Requester:
 
 
     def evaluate_global_model(self):
-        self.global_model.eval()  # 设置模型为评估模式
-        total_loss, correct, total = 0.0, 0, 0
-        with torch.no_grad():  # 在评估时不需要计算梯度
-            for inputs, labels in self.test_loader: # 假设 self.test_loader 是您的测试数据加载器
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-
-                # --- 开始关键修复 ---
-                # 确保标签是 Long 类型，以适配例如 nn.CrossEntropyLoss
-                if labels.dtype != torch.long:
-                    labels = labels.to(torch.long)
-                # --- 关键修复结束 ---
-
-                outputs = self.global_model(inputs)
-                loss = self.criterion(outputs, labels) # 如果criterion是CrossEntropyLoss，这里labels必须是Long
-
-                total_loss += loss.item() * inputs.size(0) # 累加总损失
-                _, predicted = torch.max(outputs.data, 1)  # 获取预测结果
-                total += labels.size(0)  # 累加样本总数
-                correct += (predicted == labels).sum().item() # 累加正确预测的样本数
-
-        if total == 0: # 处理测试集为空的情况
-            return 0.0, float('inf')
-        
-        accuracy = correct / total
-        average_loss = total_loss / total
+        # 同一版本的全局模型只在测试集上评估一次
+        if self.model_version not in self._global_evaluation_cache:
+            self._global_evaluation_cache = {self.model_version: self._evaluate_global_model_uncached()}
+        return self._global_evaluation_cache[self.model_version]
+
+
+    def _evaluate_global_model_uncached(self):
+        need_sample_correct = self.verification_mode == "sequential"
+        accuracy, average_loss, sample_correct = self.test_loader.evaluate(self.global_model, return_sample_correct=need_sample_correct)
+        if need_sample_correct and sample_correct is not None:
+            self._global_sample_correct = sample_correct
+            self._test_tensors = (self.test_loader.inputs, self.test_loader.labels)
         return accuracy, average_loss
 
 
-    def select_participants(self, participants, M_t, reputation_threshold):
-        active_bidders_info = []
-        for p in participants:
-            if p.reputation >= reputation_threshold and p.bid and 'promise' in p.bid and 'reward' in p.bid:
-                promise, reward = p.bid['promise'], p.bid['reward']
-                cost_effectiveness_ratio = promise / reward if reward > 1e-6 else (float('inf') if promise > 0 else float('-inf'))
-                active_bidders_info.append({"participant": p, "ratio": cost_effectiveness_ratio})
-        active_bidders_info.sort(key=lambda x: x["ratio"], reverse=True)
-        selected_participants_obj = [info["participant"] for info in active_bidders_info[:M_t]]
-        for p in participants: p.selected = (p in selected_participants_obj)
-        return selected_participants_obj
-
-
-    def verify_and_aggregate_updates(self, selected_participants_updates, current_global_accuracy):
+    # 按性价比 promise / reward 选出前 M_t 个投标者：argpartition 取 top-k，边界上的并列按槽位顺序取，
+    # 再对这 k 个稳定排序，结果与对全部投标者做稳定降序排序后取前 M_t 个相同
+    def select_participants(self, registry, M_t, reputation_threshold):
+        promise, reward = registry.bid_promise, registry.bid_reward
+        bidders = np.flatnonzero(registry.active_mask(reputation_threshold) & ~np.isnan(promise) & ~np.isnan(reward))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(reward[bidders] > 1e-6, promise[bidders] / reward[bidders],
+                             np.where(promise[bidders] > 0, np.inf, -np.inf))
+        k = max(0, min(M_t, len(bidders)))
+        if 0 < k < len(bidders):
+            kth_ratio = -np.partition(-ratio, k - 1)[k - 1]
+            above, tied = np.flatnonzero(ratio > kth_ratio), np.flatnonzero(ratio == kth_ratio)
+            top = np.concatenate([above, tied[:k - len(above)]])
+        else:
+            top = np.arange(k)
+        top = np.sort(top)
+        selected_slots = bidders[top[np.argsort(-ratio[top], kind='stable')]]
+        registry.selected[:] = False
+        registry.selected[selected_slots] = True
+        return [registry.participants[slot] for slot in selected_slots]
+
+
+    # 当前版本全局模型在测试集上的平均交叉熵损失对参数的梯度 (展平为 [d])，按模型版本缓存
+    def _test_loss_gradient(self):
+        if self._loss_gradient_version != self.model_version:
+            if self._loss_gradient is None: self._loss_gradient = torch.zeros_like(self.global_model.flat_params)
+            self._loss_gradient.zero_()
+            gradient_views = list(unflatten_state(self._loss_gradient, self.global_model.state_dict()).values())
+            params = list(self.global_model.parameters())
+            num_samples = len(self.test_loader.dataset)
+            self.global_model.eval()
+            for inputs, labels in self.test_loader:
+                loss = nn.functional.cross_entropy(self.global_model(inputs), labels, reduction='sum') / num_samples
+                for view, grad in zip(gradient_views, torch.autograd.grad(loss, params)): view.add_(grad)
+            self._loss_gradient_version = self.model_version
+        return self._loss_gradient
+
+
+    # 一阶预测的测试损失变化 g·u (每个候选 O(d))
+    def predict_loss_change(self, update, reference_state):
+        update_flat = self._flatten_update(update, reference_state).to(self.device)
+        return torch.dot(self._test_loss_gradient(), update_flat).item()
+
+
+    # 分组检验 (update_rows 为 [M, d] 候选更新矩阵)：草稿模型载入 "全局参数 + 组内平均更新" 评估一次，
+    # 组的提升不低于组内平均承诺时整组通过，否则二分后递归；单个候选即为普通的逐个验证。
+    # 组通过只说明组内多数更新有效，不能证明每个成员都有贡献：按一阶得分 a_i = -g·u_i 归属份额
+    # share_i = 组提升 · min(1, a_i / mean(a))，成员按份额从低到高单独复验 (份额只决定顺序)；
+    # 设置了 group_attribution_margin 时，份额不低于 promise + margin 的成员直接按份额判定，不再复验。
+    # 返回每个候选的 (准确率, 评估时所在组的大小, 是否为未经单独评估的一阶归属估计)；
+    # 失败组的测试集评估次数约为 O(失败者数 · log M)，另加一次测试损失梯度的计算 (按模型版本缓存)
+    def _group_test(self, update_rows, promises, current_global_accuracy):
+        scratch_model = self._get_scratch_model()
+        results = [None] * len(promises)
+        self.last_verification_passes = 0
+
+        def evaluate_mean_update(group):
+            weights = torch.zeros(len(promises), dtype=update_rows.dtype, device=update_rows.device)
+            weights[group] = 1.0 / len(group)
+            scratch_model.flat_params.detach().copy_(self.global_model.flat_params)
+            weighted_update_sum(update_rows, weights, out=scratch_model.flat_params)
+            acc, _ = self.evaluate_model_on_temp(scratch_model)
+            self.last_verification_passes += 1
+            return acc
+
+        pending = [list(range(len(promises)))]
+        scores = None
+        while pending:
+            group = pending.pop()
+            acc = evaluate_mean_update(group)
+            if len(group) == 1:
+                results[group[0]] = (acc, 1, False)
+                continue
+            gain = acc - current_global_accuracy
+            if gain < sum(promises[i] for i in group) / len(group):
+                mid = len(group) // 2
+                pending.extend([group[mid:], group[:mid]])
+                continue
+            if scores is None: scores = -(update_rows @ self._test_loss_gradient().to(update_rows.dtype))
+            mean_score = scores[group].mean().item()
+            shares = {i: gain * min(1.0, scores[i].item() / mean_score) if mean_score > 0 else -float('inf') for i in group}
+            for i in sorted(group, key=shares.get):
+                if self.group_attribution_margin is not None and shares[i] >= promises[i] + self.group_attribution_margin:
+                    results[i] = (current_global_accuracy + shares[i], len(group), True)
+                else:
+                    results[i] = (evaluate_mean_update([i]), 1, False)
+        return results
+
+
+    # 需要时构建核心集，并返回当前版本全局模型在核心集上的准确率 (同时用完整测试集上的准确率校准误差估计)
+    def _coreset_baseline_accuracy(self):
+        if self.verification_set is None:
+            if not self.verification_coreset_size or self.model_version < self.coreset_build_version: return None
+            self.verification_set, self.coreset_statistical_error = build_verification_coreset(
+                self.global_model, self.test_loader, self.verification_coreset_size)
+            print(f"构建紧凑验证集: {len(self.verification_set.dataset)}/{len(self.test_loader.dataset)} 个样本 "
+                  f"(全局模型版本 {self.model_version})")
+        if self._coreset_baseline[0] != self.model_version:
+            coreset_accuracy, _, _ = self.verification_set.evaluate(self.global_model)
+            full_accuracy, _ = self.evaluate_global_model()
+            self.verification_accuracy_error = max(self.coreset_statistical_error, abs(coreset_accuracy - full_accuracy))
+            self._coreset_baseline = (self.model_version, coreset_accuracy)
+        return self._coreset_baseline[1]
+
+
+    # 逐个验证时复用的草稿模型，首次使用时构造，之后每个候选都原地重置参数
+    def _get_scratch_model(self):
+        if self._scratch_model is None: self._scratch_model = Global_Model().to(self.device)
+        return self._scratch_model
+
+
+    # return_gradient_details=True 时额外返回各候选的明细 (其中的更新为提交内容的引用)，否则第二项为 None
+    def verify_and_aggregate_updates(self, selected_participants_updates, current_global_accuracy, return_gradient_details=False):
         verification_outcomes = []
         valid_param_diffs_for_aggregation = []
-        current_global_model_state = copy.deepcopy(self.global_model.state_dict())
+        current_global_model_state = self.global_model.state_dict() # 聚合前全局参数不变，直接使用视图
         
         submitted_gradient_details = []
 
+        pending_candidates = [] # (participant, gradient_detail_entry, 已评估的准确率或 None)
+
+        # 逐个/分组验证可以在核心集上进行，此时观察提升相对全局模型在核心集上的准确率计算
+        baseline_accuracy, accuracy_error = current_global_accuracy, None
+        if self.verification_mode in ("serial", "group"):
+            coreset_baseline = self._coreset_baseline_accuracy()
+            if coreset_baseline is not None: baseline_accuracy, accuracy_error = coreset_baseline, self.verification_accuracy_error
+
         for item in selected_participants_updates:
             participant = item["participant"]
             submitted_update_content = item["update"] 
             
-
-            model_to_evaluate_this_update = Global_Model().to(self.device)
-            model_to_evaluate_this_update.load_state_dict(current_global_model_state)
- 
             gradient_detail_entry = {
                 "participant_id": participant.id,
                 "participant_type": participant.type,
                 "gradient_dict": None,
                 "verified": False,
-                "error_processing": False 
+                "error_processing": False,
+                "screened_out": False,
+                "predicted_loss_change": None
             }
+            acc_after_update = None
             
             if submitted_update_content is None:
                 print(f"Error: Participant {participant.id} submitted a None gradient.")
                 gradient_detail_entry["error_processing"] = True
             else:
                 try:
-                    with torch.no_grad():
-                        for name, param_diff_val in submitted_update_content.items():
-                            if name in model_to_evaluate_this_update.state_dict(): # Ensure key exists
-                                model_to_evaluate_this_update.state_dict()[name].add_(param_diff_val.to(self.device))
-                    gradient_detail_entry["gradient_dict"] = copy.deepcopy(submitted_update_content)
+                    for name, param_diff_val in submitted_update_content.items():
+                        if name in current_global_model_state and param_diff_val.shape != current_global_model_state[name].shape:
+                            raise ValueError(f"shape mismatch for {name}: {tuple(param_diff_val.shape)}")
+                    # 一阶筛查：预测会明显增大测试损失的候选不再做完整评估
+                    if self.screening_loss_threshold is not None:
+                        predicted_loss_change = self.predict_loss_change(submitted_update_content, current_global_model_state)
+                        gradient_detail_entry["predicted_loss_change"] = predicted_loss_change
+                        gradient_detail_entry["screened_out"] = predicted_loss_change > self.screening_loss_threshold
+                    # 逐个评估：草稿模型的连续缓冲区一次写入 "全局参数 + 候选更新"，之后原地评估
+                    # (堆叠/序贯/分组模式只校验形状，准确率在全部候选收集完后一次性计算)
+                    # 分组检验同样需要展平的更新，在此处展平以便格式错误只影响该参与者
+                    if self.verification_mode == "group" and not gradient_detail_entry["screened_out"]:
+                        gradient_detail_entry["update_flat"] = self._flatten_update(submitted_update_content, current_global_model_state).to(self.device)
+                    if self.verification_mode not in ("stacked", "sequential", "group") and not gradient_detail_entry["screened_out"]:
+                        scratch_model = self._get_scratch_model()
+                        update_flat = self._flatten_update(submitted_update_content, current_global_model_state)
+                        with torch.no_grad():
+                            torch.add(self.global_model.flat_params, update_flat.to(self.device), out=scratch_model.flat_params)
+                        acc_after_update, _ = self.evaluate_model_on_temp(scratch_model)
+                    gradient_detail_entry["gradient_dict"] = submitted_update_content # 直接引用提交的更新，不复制
                 except Exception as e:
                     print(f"Error applying free_rider {participant.id} gradient for evaluation: {e}")
                     gradient_detail_entry["error_processing"] = True
+                    gradient_detail_entry["screened_out"] = False
             
             submitted_gradient_details.append(gradient_detail_entry)
-
+            pending_candidates.append((participant, gradient_detail_entry, acc_after_update))
+
+        # 堆叠验证：所有候选参数一起前向，每轮只遍历一次测试集
+        if self.verification_mode == "stacked":
+            stacked_entries = [entry for _, entry, _ in pending_candidates if not entry["error_processing"] and not entry["screened_out"]]
+            if stacked_entries:
+                stacked_params = stack_candidate_params(current_global_model_state,
+                                                        [entry["gradient_dict"] for entry in stacked_entries], self.device)
+                stacked_accs = iter(evaluate_stacked_accuracies(self.global_model, stacked_params, self.test_loader,
+                                                                self.device, self.verification_chunk_size))
+                pending_candidates = [(p, entry, acc if entry["error_processing"] or entry["screened_out"] else next(stacked_accs))
+                                      for p, entry, acc in pending_candidates]
+
+        # 序贯验证：与当前全局模型在同一打乱顺序上配对比较，置信界足以判定时提前停止
+        verification_samples = {}
+        if self.verification_mode == "sequential":
+            sequential_items = [(p, entry) for p, entry, _ in pending_candidates if not entry["error_processing"] and not entry["screened_out"]]
+            if sequential_items:
+                self.evaluate_global_model() # 确保基线的逐样本正确性对应当前版本
+                stacked_params = stack_candidate_params(current_global_model_state,
+                                                        [entry["gradient_dict"] for _, entry in sequential_items], self.device)
+                test_inputs, test_labels = self._test_tensors
+                sequential_results = sequential_verify(self.global_model, stacked_params,
+                                                       [p.bid.get('promise', 0) for p, _ in sequential_items],
+                                                       test_inputs, test_labels, self._global_sample_correct,
+                                                       self.verification_batch_size, self.verification_failure_prob,
+                                                       self.device, self.verification_generator)
+                estimated_accs = {}
+                for (p, entry), (estimated_increase, radius, samples_used, passed) in zip(sequential_items, sequential_results):
+                    estimated_accs[id(entry)] = current_global_accuracy + estimated_increase
+                    entry["sequential_radius"], entry["sequential_passed"] = radius, passed
+                    verification_samples[p.id] = samples_used
+                pending_candidates = [(p, entry, estimated_accs.get(id(entry), acc)) for p, entry, acc in pending_candidates]
+
+        # 分组检验：失败的组二分定位，通过的组的成员单独复验 (或按一阶归属份额判定并标记)
+        if self.verification_mode == "group":
+            group_items = [(p, entry) for p, entry, _ in pending_candidates if not entry["error_processing"] and not entry["screened_out"]]
+            if group_items:
+                update_rows = torch.stack([entry.pop("update_flat") for _, entry in group_items])
+                group_results = self._group_test(update_rows, [p.bid.get('promise', 0) for p, _ in group_items], baseline_accuracy)
+                group_accs = {}
+                for (_, entry), (acc, group_size, attributed) in zip(group_items, group_results):
+                    group_accs[id(entry)] = acc
+                    entry["group_size"], entry["attributed_increase"] = group_size, attributed
+                pending_candidates = [(p, entry, group_accs.get(id(entry), acc)) for p, entry, acc in pending_candidates]
+
+        for participant, gradient_detail_entry, acc_after_update in pending_candidates:
             if gradient_detail_entry["error_processing"]:
                  verification_outcomes.append({
                      "participant_id": participant.id, 
@@ -260,14 +662,26 @@ class Requester:
                      "observed_increase": -float('inf')
                 })
                  continue
+            if gradient_detail_entry["screened_out"]:
+                verification_outcomes.append({
+                    "participant_id": participant.id,
+                    "successful_verification": False,
+                    "observed_increase": -float('inf'),
+                    "screened_out": True,
+                    "predicted_loss_change": gradient_detail_entry["predicted_loss_change"]
+                })
+                continue
 
-            acc_after_update, _ = self.evaluate_model_on_temp(model_to_evaluate_this_update)
-            observed_increase = acc_after_update - current_global_accuracy
+            observed_increase = acc_after_update - baseline_accuracy
             promised_increase = participant.bid.get('promise', 0)
             
-            successful_verification = False
-            if observed_increase >= promised_increase:
-                successful_verification = True
+            # 序贯验证的提升只是部分样本上的估计：通过与否取置信界的判定，聚合时只计其置信下界
+            aggregation_increase = observed_increase
+            if "sequential_passed" in gradient_detail_entry:
+                successful_verification = gradient_detail_entry["sequential_passed"]
+                aggregation_increase = observed_increase - gradient_detail_entry["sequential_radius"]
+            else:
+                successful_verification = observed_increase >= promised_increase
             
             gradient_detail_entry["verified"] = successful_verification
             verification_outcomes.append({
@@ -275,64 +689,61 @@ class Requester:
                 "successful_verification": successful_verification,
                 "observed_increase": observed_increase
             })
+            if participant.id in verification_samples:
+                verification_outcomes[-1]["verification_samples"] = verification_samples[participant.id]
+            if gradient_detail_entry["predicted_loss_change"] is not None:
+                verification_outcomes[-1]["predicted_loss_change"] = gradient_detail_entry["predicted_loss_change"]
+            if "group_size" in gradient_detail_entry:
+                verification_outcomes[-1]["group_size"] = gradient_detail_entry["group_size"]
+                verification_outcomes[-1]["attributed_increase"] = gradient_detail_entry["attributed_increase"]
+            if accuracy_error is not None:
+                verification_outcomes[-1]["accuracy_error"] = accuracy_error
+            if gradient_detail_entry.get("sequential_radius"):
+                verification_outcomes[-1]["accuracy_error"] = gradient_detail_entry["sequential_radius"]
 
             # 修改聚合逻辑，只要 observed_increase > 0.000 就进行聚合，不需要满足 promised_increase
-            if observed_increase > 0.000 and gradient_detail_entry["gradient_dict"] is not None:
-                valid_param_diffs_for_aggregation.append((gradient_detail_entry["gradient_dict"], observed_increase))
+            if aggregation_increase > 0.000 and gradient_detail_entry["gradient_dict"] is not None:
+                valid_param_diffs_for_aggregation.append((gradient_detail_entry["gradient_dict"], aggregation_increase))
         
         if valid_param_diffs_for_aggregation:
             total_positive_observed_increase_sum = sum(w for _, w in valid_param_diffs_for_aggregation if w > 0)
             if total_positive_observed_increase_sum > 1e-6:
-                aggregated_state_diff = {key: torch.zeros_like(param_val, device=self.device, dtype=torch.float32)
-                                         for key, param_val in current_global_model_state.items()}
-                for param_diff_dict_agg, weight_agg in valid_param_diffs_for_aggregation:
-                    if weight_agg <=0: continue
-                    for key in aggregated_state_diff:
-                        if key in param_diff_dict_agg:
-                             aggregated_state_diff[key] += param_diff_dict_agg[key].to(self.device) * weight_agg
-                
-                final_aggregated_diff = {key: val / total_positive_observed_increase_sum for key, val in aggregated_state_diff.items()}
-                
-                with torch.no_grad():
-                    new_global_state = copy.deepcopy(self.global_model.state_dict())
-                    for key in new_global_state:
-                        if key in final_aggregated_diff:
-                            new_global_state[key] += final_aggregated_diff[key]
-                    self.global_model.load_state_dict(new_global_state)
+                # [k, d] 更新矩阵乘以归一化权重向量，原地累加到连续参数缓冲区
+                update_rows = [self._flatten_update(param_diff_dict_agg, current_global_model_state)
+                               for param_diff_dict_agg, weight_agg in valid_param_diffs_for_aggregation if weight_agg > 0]
+                weights = [weight_agg / total_positive_observed_increase_sum
+                           for _, weight_agg in valid_param_diffs_for_aggregation if weight_agg > 0]
+                weighted_update_sum(update_rows, weights, out=self.global_model.flat_params)
+                self.model_version += 1
                     
-        return verification_outcomes, submitted_gradient_details
+        return verification_outcomes, (submitted_gradient_details if return_gradient_details else None)
 
 
+    # 候选模型的验证评估：已构建核心集时在核心集上评估，否则使用完整测试集
     def evaluate_model_on_temp(self, temp_model_instance):
-        temp_model_instance.eval()
-        correct, total = 0, 0
-        if not self.test_loader or len(self.test_loader.dataset) == 0:
-            return 0.0, float('inf')
-            
-        with torch.no_grad():
-            for inputs, labels in self.test_loader:
-                inputs, labels = inputs.to(self.device), labels.to(self.device)
-                outputs = temp_model_instance(inputs)
-                _, predicted = torch.max(outputs.data, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-        return (correct / total) if total > 0 else 0.0, 0.0
-
-
-    def update_reputations_and_pay(self, participants, verification_outcomes, total_rewards_paid_ref):
-        for outcome in verification_outcomes:
-            participant = next((p for p in participants if p.id == outcome["participant_id"]), None)
-            if not participant or not participant.selected: continue
-
-            if participant.type == "honest_client":
-                participant.update_adaptive_commitment_stats(outcome["successful_verification"])
-
-            if outcome["successful_verification"]:
-                participant.reputation += self.alpha_reward
-                reward_to_pay = participant.bid.get('reward', 0)
-                total_rewards_paid_ref[0] += reward_to_pay
-            else:
-                participant.fail_num +=1
-                penalty = self.beta_penalty_base ** participant.fail_num
-                participant.reputation = max(0, participant.reputation - penalty)
-            participant.update_reputation_history()
\ No newline at end of file
+        evaluator = self.verification_set if self.verification_set is not None else self.test_loader
+        accuracy, _, _ = evaluator.evaluate(temp_model_instance)
+        return (accuracy, 0.0) if len(evaluator.dataset) > 0 else (0.0, float('inf'))
+
+
+    # 在注册表数组上批量完成奖惩：成功者加声誉并支付 reward，失败者 fail_num + 1 并按 beta^fail_num 扣声誉；
+    # 分组检验中只按一阶归属份额判定通过 (attributed_increase，未经单独评估) 的成员照常支付，但不增加声誉
+    def update_reputations_and_pay(self, registry, verification_outcomes, total_rewards_paid_ref):
+        slots = np.array([registry.slot_of.get(outcome["participant_id"], -1) for outcome in verification_outcomes], dtype=np.int64)
+        successful = np.array([outcome["successful_verification"] for outcome in verification_outcomes], dtype=bool)
+        attributed = np.array([outcome.get("attributed_increase", False) for outcome in verification_outcomes], dtype=bool)
+        keep = slots >= 0
+        keep[keep] = registry.selected[slots[keep]]
+        slots, successful, attributed = slots[keep], successful[keep], attributed[keep]
+
+        for slot, was_successful in zip(slots, successful):
+            if registry.is_honest[slot]:
+                registry.participants[slot].update_adaptive_commitment_stats(bool(was_successful))
+
+        won, lost = slots[successful], slots[~successful]
+        registry.reputation[slots[successful & ~attributed]] += self.alpha_reward
+        total_rewards_paid_ref[0] += float(np.nan_to_num(registry.bid_reward[won]).sum())
+        registry.fail_num[lost] += 1
+        penalties = self.beta_penalty_base ** registry.fail_num[lost].astype(np.float64)
+        registry.reputation[lost] = np.maximum(0, registry.reputation[lost] - penalties)
+        registry.push_reputation_history(slots)
\ No newline at end of file
@@ -0,0 +1,67 @@
+import torch
+import torch.nn.functional as F
+
+
+# 预加载到设备上的测试集评估器：归一化后的测试集常驻为一对张量 (inputs [n, ...], labels [n])，
+# 以大批次前向，正确数与损失在设备上累加，每次评估只同步一次。
+# 同时可按批迭代 (与 DataLoader 用法相同)，供堆叠验证等按批遍历测试集的路径直接使用。
+# sample_weights 不为 None 时 (如核心集，每个样本代表若干原始样本) evaluate 返回加权准确率/损失；按批迭代不带权重。
+class HeldOutEvaluator:
+    def __init__(self, inputs, labels, device, batch_size=2048, sample_weights=None):
+        self.device = device
+        self.inputs = inputs.to(device)
+        self.labels = labels.to(device, torch.long)
+        self.batch_size = batch_size
+        self.dataset = self.labels # len(evaluator.dataset) 与 DataLoader 一致
+        self.sample_weights = sample_weights.to(device, torch.float64) if sample_weights is not None else None
+        self.total_weight = float(self.sample_weights.sum()) if sample_weights is not None else float(len(self.labels))
+
+
+    # 由 TensorSubset (预处理好的张量视图数据集) 构建，不经过逐样本 __getitem__
+    @classmethod
+    def from_dataset(cls, dataset, device, batch_size=2048):
+        return cls(dataset.base_data[dataset.indices], dataset.base_targets[dataset.indices], device, batch_size)
+
+
+    # 由任意批迭代器构建：遍历一次并拼接成常驻张量
+    @classmethod
+    def from_loader(cls, loader, device, batch_size=None):
+        batches = list(loader)
+        inputs = torch.cat([inputs for inputs, _ in batches]) if batches else torch.empty(0)
+        labels = torch.cat([labels for _, labels in batches]) if batches else torch.empty(0, dtype=torch.long)
+        return cls(inputs, labels, device, batch_size or getattr(loader, "batch_size", None) or 2048)
+
+
+    def __len__(self):
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
+
+
+    def __iter__(self):
+        for start in range(0, len(self.labels), self.batch_size):
+            yield self.inputs[start: start + self.batch_size], self.labels[start: start + self.batch_size]
+
+
+    # 返回 (准确率, 平均损失, 逐样本正确性或 None)；测试集为空时为 (0.0, inf, None)
+    def evaluate(self, model, return_sample_correct=False):
+        num_samples = len(self.labels)
+        if num_samples == 0: return 0.0, float('inf'), None
+        model.eval()
+        correct = torch.zeros((), dtype=torch.float64, device=self.device)
+        total_loss = torch.zeros((), dtype=torch.float64, device=self.device)
+        sample_correct = torch.empty(num_samples, dtype=torch.bool, device=self.device) if return_sample_correct else None
+        with torch.no_grad():
+            for start in range(0, num_samples, self.batch_size):
+                inputs, labels = self.inputs[start: start + self.batch_size], self.labels[start: start + self.batch_size]
+                outputs = model(inputs)
+                batch_correct = outputs.argmax(dim=1) == labels
+                if self.sample_weights is None:
+                    total_loss += F.cross_entropy(outputs, labels, reduction='sum')
+                    correct += batch_correct.sum()
+                else:
+                    weights = self.sample_weights[start: start + self.batch_size]
+                    total_loss += (F.cross_entropy(outputs, labels, reduction='none').double() * weights).sum()
+                    correct += (batch_correct.double() * weights).sum()
+                if sample_correct is not None: sample_correct[start: start + self.batch_size] = batch_correct
+        num_correct, total_loss = torch.stack([correct, total_loss]).tolist() # 唯一一次同步
+        total_weight = num_samples if self.sample_weights is None else self.total_weight
+        return num_correct / total_weight, total_loss / total_weight, sample_correct
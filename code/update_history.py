@@ -0,0 +1,67 @@
+import torch
+
+
+# 固定容量的全局更新历史环形缓冲区：预分配 [capacity + 1, d] 张量并缓存每条更新的 L2 范数。
+# 多出的一行始终不属于有效历史，作为下一次写入的槽位，写入后未确认 (commit) 也不会破坏已有记录。
+# 按列表方式访问 (len / history[-1] / 迭代从旧到新)，返回的是缓冲区的视图；
+# 视图在之后第 capacity 次写入时才会被覆盖，消费者应在每轮重新读取而不是长期持有。
+class UpdateHistoryBuffer:
+    def __init__(self, capacity, device=None):
+        self.capacity = capacity
+        self.device = device
+        self.updates = None # 首次写入时按更新维度分配
+        self.norms = None
+        self.start = 0
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def _slot(self, index):
+        if index < 0: index += self.size
+        if not 0 <= index < self.size: raise IndexError("更新历史索引越界")
+        return (self.start + index) % (self.capacity + 1)
+
+
+    def __getitem__(self, index):
+        return self.updates[self._slot(index)]
+
+
+    def __iter__(self):
+        for i in range(self.size): yield self[i]
+
+
+    # 缓存的范数 (0 维张量，留在设备上)
+    def norm(self, index):
+        return self.norms[self._slot(index)]
+
+
+    # 下一条写入位置的视图，可用 out= 直接写入，确认后调用 commit
+    def next_slot(self, reference):
+        if self.updates is None:
+            device = self.device if self.device is not None else reference.device
+            self.updates = torch.zeros(self.capacity + 1, reference.numel(), dtype=reference.dtype, device=device)
+            self.norms = torch.zeros(self.capacity + 1, dtype=reference.dtype, device=device)
+        return self.updates[(self.start + self.size) % (self.capacity + 1)]
+
+
+    def commit(self, norm=None):
+        slot = (self.start + self.size) % (self.capacity + 1)
+        self.norms[slot] = torch.linalg.norm(self.updates[slot]) if norm is None else norm
+        if self.size < self.capacity: self.size += 1
+        else: self.start = (self.start + 1) % (self.capacity + 1)
+
+
+    def append(self, update_flat, norm=None):
+        self.next_slot(update_flat).copy_(update_flat.detach().reshape(-1))
+        self.commit(norm)
+
+
+    # 最近 count 条更新的紧凑副本 (CPU)，用于跨进程传递
+    def latest(self, count):
+        snapshot = UpdateHistoryBuffer(count, device=torch.device("cpu"))
+        for i in range(max(0, self.size - count), self.size):
+            snapshot.append(self[i].cpu(), self.norm(i).cpu())
+        return snapshot
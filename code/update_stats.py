@@ -0,0 +1,81 @@
+import math
+import torch
+
+
+# 一次性计算 [n, d] 更新矩阵的统计量：Gram 矩阵、L2 范数、标准差及两两余弦相似度。
+# 给定 reference_mask (长度 n 的布尔向量) 时，再计算每行与参考行均值方向 m = Σ a_j u_j 的余弦，
+# 以及 m 自身的范数/标准差；normalize_reference=True 时 a_j = 1/||u_j|| (先归一化再求和)，否则 a_j = 1/|R|。
+# m 不需要显式构造：u_i·m = (G a)_i，||m||² = aᵀ G a，Σ_k m_k = aᵀ (U 1)。
+# 范数不超过 eps 的行余弦记为 0；没有参考行时 mean_* 为 None，均值方向范数不超过 eps 时 mean_cosine 为 None。
+# updates 为草图 [n, k] 时，传入原始维度 dim 和提交时精确计算的行和 sums，标准差由 (估计的) 范数和行和推出。
+def update_statistics(updates, reference_mask=None, normalize_reference=False, eps=1e-9, dim=None, sums=None):
+    n, d = updates.shape
+    gram = updates @ updates.t()
+    norms = gram.diagonal().clamp(min=0).sqrt()
+    if sums is None:
+        sums, dim = updates.sum(dim=1), d
+        stds = updates.std(dim=1) if d > 1 else torch.zeros(n, dtype=updates.dtype, device=updates.device)
+    else:
+        sums = torch.as_tensor(sums, dtype=updates.dtype, device=updates.device)
+        stds = ((norms.pow(2) - sums.pow(2) / dim) / (dim - 1)).clamp(min=0).sqrt()
+    nonzero = norms > eps
+    safe_norms = torch.where(nonzero, norms, torch.ones_like(norms))
+    pairwise_cosine = gram / (safe_norms[:, None] * safe_norms[None, :])
+    pairwise_cosine = pairwise_cosine * (nonzero[:, None] & nonzero[None, :])
+    stats = {"gram": gram, "norms": norms, "stds": stds, "pairwise_cosine": pairwise_cosine,
+             "mean_cosine": None, "mean_norm": None, "mean_std": None}
+    if reference_mask is None: return stats
+
+    reference_mask = torch.as_tensor(reference_mask, dtype=torch.bool, device=updates.device)
+    if normalize_reference: weights = (reference_mask & nonzero).to(updates.dtype) / safe_norms
+    else: weights = reference_mask.to(updates.dtype) / max(int(reference_mask.sum()), 1)
+    dots_with_mean = gram @ weights
+    mean_norm = torch.dot(weights, dots_with_mean).clamp(min=0).sqrt()
+    if not reference_mask.any(): return stats
+
+    stats["mean_norm"] = mean_norm
+    if dim > 1:
+        mean_sum = torch.dot(weights, sums)
+        stats["mean_std"] = ((mean_norm.pow(2) - mean_sum.pow(2) / dim) / (dim - 1)).clamp(min=0).sqrt()
+    if mean_norm.item() > eps:
+        stats["mean_cosine"] = dots_with_mean / (safe_norms * mean_norm) * nonzero
+    return stats
+
+
+# 随机投影草图：提交时把 d 维展平更新投影到 k 维，之后的相似度/范数统计与历史记录都在 k 维上进行。
+# "count_sketch"：每个坐标按固定哈希落入一个桶并乘以随机符号，只需 O(d) 的索引；
+# "jl"：高斯投影 N(0, 1/k)，投影矩阵按块由固定种子重新生成，不常驻 [d, k] 矩阵；
+#       每次调用都要重新生成 d·k 个随机数，调用方应把一轮的更新堆叠为 [n, d] 一次投影。
+# error_bound ε：对任意一对更新，以至少 1 - failure_prob 的概率 |<Su, Sv> - <u, v>| <= ε ||u|| ||v||
+# (范数平方的相对误差同样不超过 ε)。jl 取 ε = sqrt(4 ln(4/δ) / k) (Achlioptas 2003)，
+# count_sketch 由方差上界 2/k 和 Chebyshev 不等式取 ε = sqrt(2 / (k δ))。
+class UpdateSketcher:
+    def __init__(self, dim, sketch_dim, method="count_sketch", seed=0, failure_prob=0.05, device="cpu", chunk_size=1 << 16):
+        self.dim, self.sketch_dim, self.method = dim, sketch_dim, method
+        self.seed, self.failure_prob, self.device, self.chunk_size = seed, failure_prob, device, chunk_size
+        generator = torch.Generator().manual_seed(seed)
+        if method == "count_sketch":
+            self.buckets = torch.randint(sketch_dim, (dim,), generator=generator).to(device)
+            self.signs = (torch.randint(2, (dim,), generator=generator) * 2 - 1).float().to(device)
+            self.error_bound = math.sqrt(2.0 / (sketch_dim * failure_prob))
+        elif method == "jl":
+            self.error_bound = math.sqrt(4.0 * math.log(4.0 / failure_prob) / sketch_dim)
+        else:
+            raise ValueError(f"未知的草图方法: {method}")
+
+
+    # 投影一个 [d] 向量或 [n, d] 矩阵，返回 [k] / [n, k]
+    def sketch(self, updates):
+        squeeze = updates.dim() == 1
+        updates = updates.reshape(-1, self.dim).to(self.device, torch.float32)
+        sketches = torch.zeros(updates.shape[0], self.sketch_dim, device=self.device)
+        if self.method == "count_sketch":
+            sketches.index_add_(1, self.buckets, updates * self.signs)
+        else:
+            generator = torch.Generator().manual_seed(self.seed)
+            scale = 1.0 / math.sqrt(self.sketch_dim)
+            for start in range(0, self.dim, self.chunk_size):
+                rows = min(self.chunk_size, self.dim - start)
+                projection = torch.randn(rows, self.sketch_dim, generator=generator).to(self.device) * scale
+                sketches.addmm_(updates[:, start: start + rows], projection)
+        return sketches[0] if squeeze else sketches
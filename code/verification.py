@@ -0,0 +1,91 @@
+import math
+import torch
+from torch.func import functional_call, vmap
+
+
+# 将候选更新叠加到全局参数上，得到按第 0 维堆叠的参数字典 {name: [M, ...]}
+def stack_candidate_params(global_state, candidate_updates, device):
+    stacked = {}
+    for name, global_param in global_state.items():
+        global_param = global_param.to(device)
+        stacked[name] = torch.stack([global_param + update[name].to(device) if name in update else global_param
+                                     for update in candidate_updates])
+    return stacked
+
+
+# 单次遍历测试集，同时评估 M 个候选模型的准确率；chunk_size 限制每次前向的候选数以控制显存
+def evaluate_stacked_accuracies(model, stacked_params, test_loader, device, chunk_size=None):
+    num_candidates = next(iter(stacked_params.values())).shape[0]
+    if num_candidates == 0: return []
+    chunk_size = chunk_size or num_candidates
+
+    model.eval()
+    batched_forward = vmap(lambda params, inputs: functional_call(model, params, (inputs,)), in_dims=(0, None))
+    correct = torch.zeros(num_candidates, dtype=torch.long, device=device)
+    total = 0
+    with torch.no_grad():
+        for inputs, labels in test_loader:
+            inputs, labels = inputs.to(device), labels.to(device)
+            for start in range(0, num_candidates, chunk_size):
+                chunk = {name: p[start: start + chunk_size] for name, p in stacked_params.items()}
+                predicted = batched_forward(chunk, inputs).argmax(dim=-1) # [m, B]
+                correct[start: start + chunk_size] += (predicted == labels).sum(dim=1)
+            total += labels.size(0)
+    if total == 0: return [0.0] * num_candidates
+    return (correct.double() / total).tolist()
+
+
+# 经验 Bernstein 置信半径 (Maurer & Pontil 2009)，样本取值范围为 value_range
+def empirical_bernstein_radius(sample_var, n, value_range, delta):
+    log_term = math.log(2.0 / delta)
+    return math.sqrt(2.0 * sample_var * log_term / n) + 7.0 * value_range * log_term / (3.0 * max(n - 1, 1))
+
+
+# 序贯验证：候选模型与基线在同一打乱顺序的测试批次上做配对比较，
+# 逐样本差值 d_i = 1[候选正确] - 1[基线正确] ∈ {-1, 0, 1}；当置信区间完全位于 promise 的一侧时提前停止。
+# 每个候选在 K 个检查点上做联合界 (delta / K)，判定错误率不超过 failure_prob。
+# 返回 [(估计的准确率提升, 置信半径, 使用的样本数, 是否达到 promise)]；
+# 是否通过由置信界决定，跑完整个测试集时估计即为精确值 (半径为 0)，按 估计 >= promise 判定。
+def sequential_verify(model, stacked_params, promises, test_inputs, test_labels, baseline_correct,
+                      batch_size, failure_prob, device, generator=None):
+    num_candidates = len(promises)
+    if num_candidates == 0: return []
+    num_samples = test_labels.shape[0]
+    order = torch.randperm(num_samples, generator=generator).to(device)
+    num_checks = (num_samples + batch_size - 1) // batch_size
+    delta = failure_prob / num_checks
+
+    model.eval()
+    batched_forward = vmap(lambda params, inputs: functional_call(model, params, (inputs,)), in_dims=(0, None))
+    diff_sum = torch.zeros(num_candidates, dtype=torch.float64, device=device)
+    diff_sq_sum = torch.zeros(num_candidates, dtype=torch.float64, device=device)
+    results = [None] * num_candidates
+    active = list(range(num_candidates))
+    active_params = stacked_params
+    seen = 0
+    with torch.no_grad():
+        for start in range(0, num_samples, batch_size):
+            batch_indices = order[start: start + batch_size]
+            inputs, labels = test_inputs[batch_indices], test_labels[batch_indices]
+            candidate_correct = batched_forward(active_params, inputs).argmax(dim=-1) == labels # [m, B]
+            diffs = candidate_correct.double() - baseline_correct[batch_indices].double()
+            diff_sum[active] += diffs.sum(dim=1)
+            diff_sq_sum[active] += diffs.pow(2).sum(dim=1)
+            seen += labels.size(0)
+
+            means = (diff_sum[active] / seen).tolist()
+            variances = ((diff_sq_sum[active] - diff_sum[active].pow(2) / seen) / max(seen - 1, 1)).clamp(min=0).tolist()
+            still_active = []
+            for k, mean, var in zip(active, means, variances):
+                radius = empirical_bernstein_radius(var, seen, 2.0, delta)
+                if seen == num_samples:
+                    results[k] = (mean, 0.0, seen, mean >= promises[k])
+                elif mean - radius >= promises[k] or mean + radius < promises[k]:
+                    results[k] = (mean, radius, seen, mean - radius >= promises[k])
+                else:
+                    still_active.append(k)
+            if len(still_active) != len(active) and still_active:
+                active_params = {name: p[still_active] for name, p in stacked_params.items()}
+            active = still_active
+            if not active: break
+    return results